@@ -0,0 +1,626 @@
+"""Нагрузочный прогон бота без сети.
+
+Поднимает в отдельном процессе заглушки выгрузки Google и Bot API (с
+настраиваемой задержкой, размером листа и долей ошибок) и гоняет через
+настоящие обработчики bot.py (/download и кнопки) N одновременных
+пользователей. В конце печатает пропускную способность, p50/p99 и пиковую
+память процесса бота.
+
+    python benchmark.py --users 50 --requests 5 --mode csv --rows 20000
+    python benchmark.py --entry button --export-latency 300 --export-errors 0.1
+
+Готовые сценарии (--scenario, отдельные флаги их переопределяют):
+
+    python benchmark.py --scenario overlap   # медленный Google: выгрузки идут
+                                             # одновременно, /help не ждёт их
+    python benchmark.py --scenario big-csv   # листы по ~100 MB: пиковая память
+                                             # не растёт с размером листа
+
+С --startup N вместо нагрузки N раз запускает python bot.py в режиме
+webhook и меряет время от старта процесса до ответа /health и до первого
+ответа пользователю на /download (как после перезапуска на Render):
+
+    python benchmark.py --startup 5 --snapshots
+
+С --index-rows N собирает колоночный индекс (/find, since) по листу из N
+строк и меряет время сборки, память и время поиска - без заглушек, а
+затем показывает, что с ним сделает MemoryGovernor при MEMORY_SOFT_MB/HARD_MB:
+
+    python benchmark.py --index-rows 1000000
+
+С --worker-restart проверяет, что после гибели процесса-обработчика
+(WORKERS=2) его чаты снова получают ответы:
+
+    python benchmark.py --worker-restart
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import psutil
+from aiohttp import web
+
+# ========== СЦЕНАРИИ ==========
+SCENARIOS = {
+    # Выгрузка из Google по секунде на лист, кэш выключен: при неблокирующем
+    # клиенте выгрузки разных пользователей и листов перекрываются, а
+    # /help во время них отвечает сразу
+    'overlap': {'users': 10, 'requests': 2, 'tabs': 8, 'export_latency': 1000, 'cache_ttl': 0, 'probe': True},
+    # Синтетический CSV ~100 MB на лист (два листа), несколько пользователей
+    # сразу: выгрузка идёт потоком во временный файл, а не в память, так что
+    # пик памяти - десятки MB, а не сотни
+    'big-csv': {'users': 3, 'requests': 1, 'rows': 1930000, 'export_latency': 0},
+}
+
+# ========== ЗАГЛУШКИ GOOGLE И BOT API ==========
+def make_csv(gid, rows):
+    lines = ["Номер карты,Телефон,Дата,Сумма"]
+    for i in range(rows):
+        lines.append(f"2200 {int(gid) % 10000:04d} {i // 10000:04d} {i % 10000:04d},+7 (999) {i % 1000:03d}-{i % 100:02d}-{i % 7:02d},{1 + i % 28:02d}.{1 + i % 12:02d}.2024,{i % 5000}")
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+def build_fake_app(options):
+    """Выгрузки: /spreadsheets/d/<id>/export, Bot API: /bot<token>/<метод>, счётчики: /stats"""
+    stats = {'exports': 0, 'export_errors': 0, 'api_calls': 0, 'api_errors': 0, 'uploads': 0,
+             'uploaded_bytes': 0, 'reused_file_ids': 0, 'error_replies': 0, 'replies': 0, 'exported_bytes': 0}
+    payloads = {}
+    message_ids = itertools.count(1)
+    file_ids = itertools.count(1)
+
+    async def export(request):
+        stats['exports'] += 1
+        await asyncio.sleep(options.export_latency / 1000)
+        if options.export_errors and os.urandom(1)[0] < options.export_errors * 256:
+            stats['export_errors'] += 1
+            return web.Response(status=500)
+        gid = request.query.get('gid', '0')
+        if gid not in payloads:
+            payloads[gid] = make_csv(gid, options.rows)
+        stats['exported_bytes'] += len(payloads[gid])
+        return web.Response(body=payloads[gid], content_type='text/csv')
+
+    def message(chat_id, **extra):
+        return {
+            'message_id': next(message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            **extra,
+        }
+
+    async def bot_api(request):
+        stats['api_calls'] += 1
+        method = request.match_info['method']
+        if request.content_type.startswith('multipart/'):
+            data = {}
+            async for part in await request.multipart():
+                if part.filename:
+                    size = len(await part.read())
+                    stats['uploads'] += 1
+                    stats['uploaded_bytes'] += size
+                else:
+                    data[part.name] = await part.text()
+        elif request.content_type == 'application/json':
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+
+        await asyncio.sleep(options.api_latency / 1000)
+        if method != 'getMe' and options.api_errors and os.urandom(1)[0] < options.api_errors * 256:
+            stats['api_errors'] += 1
+            return web.json_response(
+                {'ok': False, 'error_code': 429, 'description': 'Too Many Requests: retry after 1', 'parameters': {'retry_after': 1}},
+                status=429,
+            )
+
+        if method in ('sendMessage', 'sendDocument'):
+            stats['replies'] += 1
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method == 'sendDocument':
+            if isinstance(data.get('document'), str):
+                stats['reused_file_ids'] += 1
+            n = next(file_ids)
+            result = message(data['chat_id'], document={'file_id': f"F{n}", 'file_unique_id': f"U{n}"})
+        elif method in ('sendMessage', 'editMessageText'):
+            if str(data.get('text', '')).startswith('❌'):
+                stats['error_replies'] += 1
+            result = message(data.get('chat_id', 1), text=data.get('text', ''))
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_get('/spreadsheets/d/{spreadsheet_id}/export', export)
+    app.router.add_post('/bot{token}/{method}', bot_api)
+    app.router.add_get('/stats', get_stats)
+    return app
+
+def serve_fakes(options, port):
+    web.run_app(build_fake_app(options), host='127.0.0.1', port=port, access_log=None, print=None)
+
+# ========== ПРОГОН ==========
+class PeakRss:
+    """Пиковая память процесса: psutil раз в 20 мс в отдельном потоке"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        process = psutil.Process()
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def command_update(update_id, chat_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': chat_id, 'is_bot': False, 'first_name': f"User{chat_id}"},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}],
+        },
+    }
+
+def button_update(update_id, chat_id, mode):
+    user = {'id': chat_id, 'is_bot': False, 'first_name': f"User{chat_id}"}
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': str(chat_id),
+            'data': f"download_{mode}",
+            'from': user,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': 1, 'is_bot': True, 'first_name': 'Benchmark'},
+                'text': "Нажмите кнопку для скачивания файлов:",
+            },
+        },
+    }
+
+async def fetch_stats(base_url):
+    import httpx
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"{base_url}/stats")).json()
+
+async def run_load(bot, options, base_url):
+    from telegram import Update
+    from telegram.ext import Application
+
+    application = (
+        Application.builder()
+        .token(bot.TOKEN)
+        .base_url(f"{base_url}/bot")
+        .concurrent_updates(True)
+        .updater(None)
+        .build()
+    )
+    bot.register_handlers(application)
+    update_ids = itertools.count(1)
+    latencies = []
+    probes = []
+    done = asyncio.Event()
+
+    async def user(chat_id):
+        for _ in range(options.requests):
+            update_id = next(update_ids)
+            if options.entry == 'button':
+                payload = button_update(update_id, chat_id, options.mode)
+            else:
+                payload = command_update(update_id, chat_id, f"/download {options.mode}")
+            started = time.perf_counter()
+            await application.process_update(Update.de_json(payload, application.bot))
+            latencies.append(time.perf_counter() - started)
+
+    async def probe():
+        """/help от отдельного чата каждые 100 мс, пока идут выгрузки"""
+        while not done.is_set():
+            payload = command_update(next(update_ids), 999999, "/help")
+            started = time.perf_counter()
+            await application.process_update(Update.de_json(payload, application.bot))
+            probes.append(time.perf_counter() - started)
+            await asyncio.sleep(0.1)
+
+    async def users():
+        await asyncio.gather(*(user(1000 + n) for n in range(options.users)))
+        done.set()
+
+    async with application:
+        before = await fetch_stats(base_url)
+        started = time.perf_counter()
+        await asyncio.gather(users(), *([probe()] if options.probe else []))
+        elapsed = time.perf_counter() - started
+        after = await fetch_stats(base_url)
+    await bot.job_log.flush()
+    await bot.close_http_client()
+    stats = {key: after[key] - before.get(key, 0) for key in after}
+    stats['probes'] = probes
+    return latencies, elapsed, stats
+
+def write_sheets_config(options, path):
+    """--tabs N: одна таблица из N листов вместо встроенных двух"""
+    if not options.tabs:
+        return
+    config = {'datasets': {'benchmark': {
+        'title': "Benchmark",
+        'spreadsheet_id': "benchmark",
+        'sheets': {f"Лист_{gid}": str(gid) for gid in range(options.tabs)},
+    }}}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+
+def configure_environment(options, workdir, base_url):
+    """Настройки бота - до его импорта: заглушки вместо Google и Telegram,
+    файлы состояния во временном каталоге, лимиты отправки из аргументов"""
+    write_sheets_config(options, os.path.join(workdir, 'sheets.json'))
+    os.environ.update({
+        'BENCHMARK_WORKDIR': workdir,
+        'TELEGRAM_BOT_TOKEN': "1:benchmark",
+        'EXPORT_BASE_URL': base_url,
+        'SHEETS_CONFIG': os.path.join(workdir, 'sheets.json'),
+        'FILE_ID_STORE': os.path.join(workdir, 'file_ids.json'),
+        'SUBSCRIPTIONS_FILE': os.path.join(workdir, 'subscriptions.json'),
+        'JOB_LOG_DB': os.path.join(workdir, 'jobs.sqlite3'),
+        'SNAPSHOT_DIR': os.path.join(workdir, 'snapshots') if options.snapshots else '',
+        'CACHE_TTL': str(options.cache_ttl),
+        'SEND_RATE_GLOBAL': str(options.send_rate),
+        'SEND_RATE_CHAT': str(options.send_rate),
+        'SEND_BURST_CHAT': str(max(3, int(options.send_rate))),
+        'FETCH_RETRY_DELAY': "0.05",
+    })
+
+# ========== ВРЕМЯ ЗАПУСКА ==========
+WEBHOOK_SECRET = "benchmark"
+
+async def wait_until(check, timeout=60, interval=0.005):
+    """Опрашивает check(), пока она не вернёт истину; время ожидания в секундах"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            if await check():
+                return
+        except Exception:
+            pass
+        await asyncio.sleep(interval)
+    raise TimeoutError("бот не ответил вовремя")
+
+def start_bot_process(options, base_url, **env):
+    """python bot.py в режиме webhook на заглушках; возвращает процесс и адрес бота"""
+    bot_url = f"http://127.0.0.1:{options.port + 1}"
+    env = dict(os.environ, BOT_MODE='webhook', WEBHOOK_URL=bot_url, WEBHOOK_SECRET=WEBHOOK_SECRET,
+               PORT=str(options.port + 1), TELEGRAM_API_URL=f"{base_url}/bot", PREFETCH_INTERVAL="0", **env)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bot.py')
+    process = subprocess.Popen([sys.executable, script], env=env, cwd=os.environ['BENCHMARK_WORKDIR'],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process, bot_url
+
+async def stop_bot_process(process):
+    process.send_signal(signal.SIGTERM)
+    try:
+        await asyncio.to_thread(process.wait, 30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+async def request_reply(client, options, base_url, bot_url, update_id, chat_id, timeout=60):
+    """Отправляет /download в webhook и ждёт, пока бот что-нибудь ответит"""
+    before = (await client.get(f"{base_url}/stats")).json()['replies']
+    await client.post(f"{bot_url}/telegram", json=command_update(update_id, chat_id, f"/download {options.mode}"),
+                      headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET})
+    async def replied():
+        return (await client.get(f"{base_url}/stats")).json()['replies'] > before
+    await wait_until(replied, timeout)
+
+async def measure_startup(options, base_url):
+    """Один перезапуск: старт python bot.py -> /health -> первый ответ на /download"""
+    import httpx
+    async with httpx.AsyncClient(timeout=60) as client:
+        started = time.perf_counter()
+        process, bot_url = start_bot_process(options, base_url)
+        try:
+            async def healthy():
+                return (await client.get(f"{bot_url}/health")).status_code == 200
+            await wait_until(healthy)
+            health = time.perf_counter() - started
+
+            # Как разбуженный запрос пользователя: webhook отвечает, когда
+            # обновление принято, ответ бота виден по счётчику заглушки
+            await request_reply(client, options, base_url, bot_url, 1, 1000)
+            first_reply = time.perf_counter() - started
+        finally:
+            await stop_bot_process(process)
+    return health, first_reply
+
+def run_startup(options, base_url):
+    results = [asyncio.run(measure_startup(options, base_url)) for _ in range(options.startup)]
+    health = [value * 1000 for value, _ in results]
+    first_reply = [value * 1000 for _, value in results]
+    print("=" * 60)
+    print(f"🔄 Перезапусков: {options.startup}, режим: {options.mode}, "
+          f"хранилище выгрузок: {'да' if options.snapshots else 'нет'}")
+    print("-" * 60)
+    print(f"💚 До ответа /health: медиана {statistics.median(health):.0f} мс, min {min(health):.0f}, max {max(health):.0f}")
+    print(f"💬 До первого ответа: медиана {statistics.median(first_reply):.0f} мс, min {min(first_reply):.0f}, max {max(first_reply):.0f}")
+    print("=" * 60)
+    if options.json:
+        print(json.dumps({
+            'health_ms': statistics.median(health),
+            'first_reply_ms': statistics.median(first_reply),
+        }))
+
+# ========== ИНДЕКС ПОИСКА ==========
+def run_index_benchmark(bot, options, lookups=10000):
+    """Сборка SheetIndex по листу из options.index_rows строк и поиск по нему"""
+    import datetime
+    import random
+
+    with tempfile.NamedTemporaryFile(prefix='index-', suffix='.csv', delete=False) as f:
+        data = make_csv('1', options.index_rows)
+        f.write(data)
+        size = len(data)
+        del data
+    snapshot = bot.Snapshot(f"index-{options.index_rows}", size, None, None, time.monotonic(), path=f.name)
+
+    rss_before = psutil.Process().memory_info().rss
+    with PeakRss() as peak:
+        started = time.perf_counter()
+        index = bot.SheetIndex.build(snapshot, ('Номер карты', 'Телефон'))
+        build = time.perf_counter() - started
+    rss_after = psutil.Process().memory_info().rss
+
+    results = {}
+    sample = random.Random(1).sample(range(index.row_count), min(lookups, index.row_count))
+    for name in ('Номер карты', 'Телефон'):
+        column = index.column(name)
+        values = [index.row(n)[column] for n in sample]
+        started = time.perf_counter()
+        found = sum(len(index.find(column, value)) > 0 for value in values)
+        results[name] = ((time.perf_counter() - started) / len(values), found)
+
+    column = index.date_column()
+    day = datetime.date(2024, 12, 1)
+    started = time.perf_counter()
+    since_rows = len(index.since(column, day))
+    since_first = time.perf_counter() - started
+    started = time.perf_counter()
+    index.since(column, day)
+    since_again = time.perf_counter() - started
+
+    # Как на это отреагирует MemoryGovernor бота: индекс лежит в кэше, как
+    # после /find, и делается одна проверка памяти
+    bot.sheet_indexes._entries[snapshot.sha256] = index
+    governor = bot.memory_governor
+    asyncio.run(governor.check())
+    index_kept = snapshot.sha256 in bot.sheet_indexes
+
+    print("=" * 60)
+    print(f"📄 Лист: {index.row_count} строк, {size / 1024 / 1024:.1f} MB CSV")
+    print("-" * 60)
+    print(f"🏗  Сборка индекса: {build:.2f} с, память +{(rss_after - rss_before) / 1024 / 1024:.1f} MB "
+          f"(пик +{(peak.peak - rss_before) / 1024 / 1024:.1f} MB)")
+    for name, (per_lookup, found) in results.items():
+        print(f"🔍 Поиск по «{name}»: {per_lookup * 1e6:.1f} мкс на запрос ({found}/{len(sample)} найдено)")
+    print(f"📅 since {day:%d.%m.%Y}: {since_rows} строк, первый раз {since_first:.2f} с, повторно {since_again:.2f} с")
+    print(f"📦 Индекс по своей оценке: {index.nbytes / 1024 / 1024:.1f} MB")
+    print(f"🧠 RSS процесса {governor.rss_mb:.1f} MB (мягкий порог {governor.soft_mb}, жёсткий {governor.hard_mb}): "
+          f"сбросов кэшей {governor.shed_count}, индекс {'остался в кэше' if index_kept else 'ВЫБРОШЕН - следующий /find соберёт его заново'}"
+          f"{', выгрузки приостановлены' if governor.overloaded else ''}")
+    print("=" * 60)
+    if options.json:
+        print(json.dumps({
+            'rows': index.row_count,
+            'build_s': build,
+            'index_mb': (rss_after - rss_before) / 1024 / 1024,
+            **{f"lookup_us_{n}": per_lookup * 1e6 for n, (per_lookup, found) in enumerate(results.values())},
+            'since_first_s': since_first,
+            'since_again_s': since_again,
+            'index_nbytes_mb': index.nbytes / 1024 / 1024,
+            'rss_mb': governor.rss_mb,
+            'governor_sheds': governor.shed_count,
+            'index_kept': index_kept,
+        }))
+
+# ========== ПЕРЕЗАПУСК ОБРАБОТЧИКОВ ==========
+async def check_worker_restart(options, base_url, workers=2):
+    """WORKERS > 1: убивает все процессы-обработчики, ждёт, пока главный
+    процесс их поднимет, и проверяет, что чаты каждого снова получают ответы"""
+    import httpx
+    chats = [1000 + n for n in range(workers)]  # chat_id % WORKERS - по чату на обработчик
+    async with httpx.AsyncClient(timeout=60) as client:
+        process, bot_url = start_bot_process(options, base_url, WORKERS=str(workers))
+        try:
+            async def healthy():
+                return (await client.get(f"{bot_url}/health")).status_code == 200
+            await wait_until(healthy)
+            update_ids = itertools.count(1)
+            for chat_id in chats:
+                await request_reply(client, options, base_url, bot_url, next(update_ids), chat_id)
+            # Обработчики простаивают в ожидании очереди - как раз тот момент,
+            # когда их смерть оставляла очередь запертой
+            await asyncio.sleep(1)
+
+            victims = [child for child in psutil.Process(process.pid).children()
+                       if 'spawn_main' in ' '.join(child.cmdline())]
+            for child in victims:
+                child.kill()
+            print(f"🔪 Убито обработчиков: {len(victims)}")
+
+            async def revived():
+                metrics = (await client.get(f"{bot_url}/metrics")).text
+                restarts = next(float(line.split()[1]) for line in metrics.splitlines()
+                                if line.startswith('worker_restarts_total '))
+                return restarts >= len(victims)
+            await wait_until(revived, interval=0.1)
+
+            for chat_id in chats:
+                try:
+                    await request_reply(client, options, base_url, bot_url, next(update_ids), chat_id, timeout=30)
+                except TimeoutError:
+                    print(f"❌ Чат {chat_id} не получил ответа после перезапуска обработчика")
+                    return False
+                print(f"✅ Чат {chat_id} обслуживается после перезапуска")
+
+            # /metrics главного процесса собирает ряды обработчиков
+            async def all_workers_reported():
+                metrics = (await client.get(f"{bot_url}/metrics")).text
+                return all(f'download_request_seconds_count{{worker="{index}"' in metrics for index in range(workers))
+            try:
+                await wait_until(all_workers_reported, timeout=10)
+            except TimeoutError:
+                print("❌ В /metrics нет выгрузок какого-то обработчика:")
+                print((await client.get(f"{bot_url}/metrics")).text)
+                return False
+            print(f"✅ /metrics показывает выгрузки всех {workers} обработчиков")
+        finally:
+            await stop_bot_process(process)
+    return True
+
+def print_report(options, latencies, elapsed, stats, rss_before, rss_peak):
+    ms = [value * 1000 for value in latencies]
+    print("=" * 60)
+    print(f"👥 Пользователей: {options.users}, запросов на пользователя: {options.requests}, режим: {options.mode} ({options.entry})")
+    tabs = f", листов: {options.tabs}" if options.tabs else ""
+    print(f"📄 Лист: {options.rows} строк{tabs}, задержка Google {options.export_latency} мс, ошибок {options.export_errors:.0%}")
+    print(f"📨 Задержка Bot API {options.api_latency} мс, 429 {options.api_errors:.0%}")
+    print("-" * 60)
+    print(f"⏱  Всего: {elapsed:.2f} с, пропускная способность: {len(latencies) / elapsed:.1f} запросов/с")
+    print(f"📈 Задержка: p50 {percentile(ms, 50):.0f} мс, p90 {percentile(ms, 90):.0f} мс, "
+          f"p99 {percentile(ms, 99):.0f} мс, max {max(ms, default=0):.0f} мс, среднее {statistics.fmean(ms) if ms else 0:.0f} мс")
+    print(f"💾 Память: {rss_before / 1024 / 1024:.1f} MB до прогона, пик {rss_peak / 1024 / 1024:.1f} MB")
+    sheet_mb = stats['exported_bytes'] / max(stats['exports'] - stats['export_errors'], 1) / 1024 / 1024
+    print(f"🌐 Запросов к выгрузке: {stats['exports']} (ошибок {stats['export_errors']}), ~{sheet_mb:.1f} MB на выгрузку")
+    print(f"📤 Загрузок файлов: {stats['uploads']} ({stats['uploaded_bytes'] / 1024 / 1024:.1f} MB), "
+          f"по file_id: {stats['reused_file_ids']}, вызовов Bot API: {stats['api_calls']} (429: {stats['api_errors']})")
+    print(f"❌ Ответов с ошибкой: {stats['error_replies']}")
+    if options.probe:
+        # Во сколько раз быстрее, чем если бы выгрузки шли по одной
+        serial = stats['exports'] * options.export_latency / 1000
+        print(f"🔀 Перекрытие выгрузок: {serial / elapsed:.1f}x ({serial:.1f} с по очереди, {elapsed:.1f} с на деле)")
+    if stats['probes']:
+        probe_ms = [value * 1000 for value in stats['probes']]
+        print(f"🩺 /help во время выгрузок: p50 {percentile(probe_ms, 50):.0f} мс, "
+              f"p99 {percentile(probe_ms, 99):.0f} мс, max {max(probe_ms):.0f} мс ({len(probe_ms)} запросов)")
+    print("=" * 60)
+    if options.json:
+        print(json.dumps({
+            'throughput': len(latencies) / elapsed,
+            'p50_ms': percentile(ms, 50),
+            'p99_ms': percentile(ms, 99),
+            'peak_rss_mb': rss_peak / 1024 / 1024,
+            **{key: value for key, value in stats.items() if key != 'probes'},
+        }))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота на локальных заглушках Google и Bot API")
+    parser.add_argument('--scenario', choices=SCENARIOS, help="готовый набор параметров (см. SCENARIOS)")
+    scenario = parser.parse_known_args(argv)[0].scenario
+    parser.add_argument('--users', type=int, default=20, help="одновременных пользователей (чатов)")
+    parser.add_argument('--requests', type=int, default=5, help="запросов подряд на пользователя")
+    parser.add_argument('--mode', default='csv', help="режим /download: csv, changed, zip, gzip, xlsx, parquet, jsonl")
+    parser.add_argument('--entry', choices=('command', 'button'), default='command', help="/download <режим> или нажатие кнопки")
+    parser.add_argument('--rows', type=int, default=5000, help="строк в каждом листе")
+    parser.add_argument('--tabs', type=int, default=0, help="листов в таблице (0 - встроенные два листа)")
+    parser.add_argument('--probe', action='store_true', help="слать /help каждые 100 мс и мерить его задержку во время выгрузок")
+    parser.add_argument('--export-latency', type=float, default=200, help="задержка выгрузки Google, мс")
+    parser.add_argument('--export-errors', type=float, default=0.0, help="доля ответов 500 от выгрузки")
+    parser.add_argument('--api-latency', type=float, default=30, help="задержка Bot API, мс")
+    parser.add_argument('--api-errors', type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument('--cache-ttl', type=int, default=180, help="CACHE_TTL бота, с (0 - без кэша)")
+    parser.add_argument('--send-rate', type=float, default=1000, help="лимит отправки в секунду (по умолчанию лимиты не мешают замеру)")
+    parser.add_argument('--snapshots', action='store_true', help="включить хранилище выгрузок на диске")
+    parser.add_argument('--port', type=int, default=18765, help="порт заглушек")
+    parser.add_argument('--worker-restart', action='store_true', help="вместо нагрузки проверить перезапуск процессов-обработчиков (WORKERS=2)")
+    parser.add_argument('--index-rows', type=int, default=0, metavar='N', help="вместо нагрузки замерить индекс поиска по листу из N строк")
+    parser.add_argument('--startup', type=int, default=0, metavar='N', help="вместо нагрузки N раз замерить запуск бота")
+    parser.add_argument('--json', action='store_true', help="дополнительно вывести итог одной строкой JSON")
+    if scenario:
+        parser.set_defaults(**SCENARIOS[scenario])
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    base_url = f"http://127.0.0.1:{options.port}"
+    if options.index_rows:
+        # Сети не нужно: только разбор листа и поиск
+        with tempfile.TemporaryDirectory(prefix='bot-benchmark-') as workdir:
+            configure_environment(options, workdir, base_url)
+            sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+            import bot
+            run_index_benchmark(bot, options)
+        return
+    fakes = multiprocessing.Process(target=serve_fakes, args=(options, options.port), daemon=True)
+    fakes.start()
+
+    with tempfile.TemporaryDirectory(prefix='bot-benchmark-') as workdir:
+        configure_environment(options, workdir, base_url)
+
+        # Ждём, пока заглушки начнут принимать соединения
+        for _ in range(100):
+            try:
+                asyncio.run(fetch_stats(base_url))
+                break
+            except Exception:
+                time.sleep(0.05)
+
+        if options.startup:
+            try:
+                run_startup(options, base_url)
+            finally:
+                fakes.terminate()
+            return
+        if options.worker_restart:
+            try:
+                ok = asyncio.run(check_worker_restart(options, base_url))
+            finally:
+                fakes.terminate()
+            sys.exit(0 if ok else 1)
+
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import logging
+        import bot
+        logging.getLogger().setLevel(logging.WARNING)
+
+        rss_before = psutil.Process().memory_info().rss
+        try:
+            with PeakRss() as peak:
+                latencies, elapsed, stats = asyncio.run(run_load(bot, options, base_url))
+        finally:
+            fakes.terminate()
+        print_report(options, latencies, elapsed, stats, rss_before, peak.peak)
+
+if __name__ == "__main__":
+    main()
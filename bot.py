@@ -1,93 +1,2826 @@
+from __future__ import annotations
+
 import os
-import requests
+import asyncio
+import importlib.util
 import logging
-from datetime import datetime
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+import hashlib
+import json
+import random
+import gc
+import io
+import mmap
+import csv
+import bisect
+import re
+import tempfile
+import weakref
+import gzip
+import mimetypes
+import shutil
+import zipfile
 import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
+import traceback
+import sqlite3
+import multiprocessing
+from array import array
+from collections import Counter, OrderedDict, deque
+from itertools import accumulate
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from aiohttp import ClientSession, ClientTimeout, web
 import signal
 import sys
 import time
 
-# ========== ПРОСТОЙ HTTP СЕРВЕР ДЛЯ RENDER PING ==========
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_HEAD(self):
-        """Для UptimeRobot (бесплатный план)"""
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-    
-    def do_GET(self):
-        """Для ручной проверки в браузере"""
-        self.send_response(200)
-        self.send_header('Content-type', 'text/plain')
-        self.end_headers()
-        self.wfile.write('OK Bot'.encode('utf-8'))
-    
-    def log_message(self, format, *args):
-        pass  # Отключаем логи запросов
-
-def run_health_server():
-    """Запускает HTTP сервер для health checks"""
-    port = int(os.environ.get('PORT', 10000))
-    server = HTTPServer(('0.0.0.0', port), HealthHandler)
-    print(f"✅ Health server started on port {port}")
-    server.serve_forever()
-
-# Запускаем health server в отдельном потоке
-health_thread = threading.Thread(target=run_health_server, daemon=True)
-health_thread.start()
+STARTED_AT = time.monotonic()
+
+# python-telegram-bot и httpx импортируются дольше всего остального вместе
+# взятого. При запуске python bot.py это происходит уже после того, как
+# health-сервер слушает порт (см. run_bot): Render после перезапуска видит
+# живой сервис сразу, а не через полсекунды-секунду импорта.
+httpx = None
+Update = InlineKeyboardButton = InlineKeyboardMarkup = Message = None
+BadRequest = Forbidden = RetryAfter = TelegramError = None
+Application = CommandHandler = CallbackQueryHandler = ContextTypes = None
+
+def load_dependencies():
+    """Импортирует telegram и httpx в глобальные имена модуля (повторный вызов ничего не делает)"""
+    global Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+    global BadRequest, Forbidden, RetryAfter, TelegramError
+    global Application, CommandHandler, CallbackQueryHandler, ContextTypes, httpx
+    if httpx is not None:
+        return
+    from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+    from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+    from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
+    import httpx
+
+# При импорте модуля (процессы-обработчики, benchmark.py) всё нужно сразу
+if __name__ != '__main__':
+    load_dependencies()
+
+# ========== НАСТРОЙКИ БОТА ==========
+SPREADSHEET_ID = "17VDwwzNG7ZLM-HAmTTApW5NARkDsieH22D7vg5_jTCA"
+SHEETS = {
+    "Список_карт_номиналов": "0",
+    "Список_номеров_СБП": "2146222680"
+}
+
+# Файл с таблицами, листами и доступом по чатам (см. sheets.example.json)
+# и как часто проверять, не изменился ли он
+SHEETS_CONFIG = os.getenv("SHEETS_CONFIG", "sheets.json")
+CONFIG_RELOAD_INTERVAL = int(os.getenv("CONFIG_RELOAD_INTERVAL", "10"))
+
+# Сколько выгрузок Google качаем одновременно (на весь процесс)
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "4"))
+
+# Устойчивость к сбоям Google: повторы с экспоненциальной паузой (первая
+# пауза FETCH_RETRY_DELAY секунд), размыкатель на таблицу - после
+# BREAKER_THRESHOLD ошибок подряд запросы к ней не идут BREAKER_COOLDOWN
+# секунд. Если в кэше есть прошлая версия, пользователь ждёт обновления не
+# дольше FETCH_BUDGET секунд и получает прошлую версию с пометкой
+FETCH_RETRIES = int(os.getenv("FETCH_RETRIES", "3"))
+FETCH_RETRY_DELAY = float(os.getenv("FETCH_RETRY_DELAY", "0.5"))
+BREAKER_THRESHOLD = int(os.getenv("BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = int(os.getenv("BREAKER_COOLDOWN", "60"))
+FETCH_BUDGET = float(os.getenv("FETCH_BUDGET", "5"))
+
+# Кэш выгрузок: сколько секунд лист считается свежим, сколько MB выгрузок
+# держать в памяти и сколько MB - во временных файлах (крупные листы).
+# TTL больше интервала фонового обновления, чтобы кэш не успевал остыть
+CACHE_TTL = int(os.getenv("CACHE_TTL", "180"))
+CACHE_MAX_MB = int(os.getenv("CACHE_MAX_MB", "50"))
+CACHE_DISK_MAX_MB = int(os.getenv("CACHE_DISK_MAX_MB", "500"))
+
+# Фоновое обновление листов: интервал в секундах (0 - выключено),
+# разброс интервала и максимальная пауза после ошибок
+PREFETCH_INTERVAL = int(os.getenv("PREFETCH_INTERVAL", "60"))
+PREFETCH_JITTER = float(os.getenv("PREFETCH_JITTER", "0.1"))
+PREFETCH_MAX_BACKOFF = int(os.getenv("PREFETCH_MAX_BACKOFF", "900"))
+
+# Потоковое скачивание: размер куска, сколько KB выгрузки держать в памяти
+# (остальное - во временном файле) и таймаут загрузки в Telegram
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_KB = int(os.getenv("SPOOL_MAX_KB", "1024"))
+UPLOAD_TIMEOUT = int(os.getenv("UPLOAD_TIMEOUT", "120"))
+
+# Лимиты исходящих сообщений (запросов в секунду): на весь бот, на один чат
+# и сколько запросов в чат можно отправить подряд без паузы
+SEND_RATE_GLOBAL = float(os.getenv("SEND_RATE_GLOBAL", "25"))
+SEND_RATE_CHAT = float(os.getenv("SEND_RATE_CHAT", "1"))
+SEND_BURST_CHAT = int(os.getenv("SEND_BURST_CHAT", "3"))
+
+# Память (лимит Render 512MB): порог сброса кэшей, порог, выше которого
+# новые выгрузки не принимаются, и порог перезапуска. Перезапуск ждёт
+# завершения активных выгрузок не дольше DRAIN_TIMEOUT секунд.
+# MAX_UPTIME_HOURS > 0 включает плановый перезапуск (раньше - каждые 48 часов)
+MEMORY_SAMPLE_INTERVAL = int(os.getenv("MEMORY_SAMPLE_INTERVAL", "10"))
+MEMORY_SOFT_MB = int(os.getenv("MEMORY_SOFT_MB", "300"))
+MEMORY_HARD_MB = int(os.getenv("MEMORY_HARD_MB", "400"))
+MEMORY_CRITICAL_MB = int(os.getenv("MEMORY_CRITICAL_MB", "470"))
+DRAIN_TIMEOUT = int(os.getenv("DRAIN_TIMEOUT", "120"))
+MAX_UPTIME_HOURS = int(os.getenv("MAX_UPTIME_HOURS", "0"))
+
+# Диагностика: через сколько секунд блокировки event loop снимать стек,
+# администраторы бота (id через запятую) и предел для /profile
+STALL_THRESHOLD = float(os.getenv("STALL_THRESHOLD", "0.5"))
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+PROFILE_MAX_SECONDS = int(os.getenv("PROFILE_MAX_SECONDS", "120"))
+
+# Поиск по листам (/find, /download <лист> since <дата>): сколько найденных
+# строк показывать прямо в сообщении (больше - отправляем CSV файлом)
+# и для скольких снимков держать разобранные индексы
+FIND_INLINE_ROWS = int(os.getenv("FIND_INLINE_ROWS", "10"))
+INDEX_CACHE_SIZE = int(os.getenv("INDEX_CACHE_SIZE", "16"))
+
+# Подписки на обновления листов (/subscribe)
+SUBSCRIPTIONS_FILE = os.getenv("SUBSCRIPTIONS_FILE", "subscriptions.json")
+
+# Журнал выгрузок для /stats: база SQLite (пустая строка - не вести), как
+# часто сбрасывать буфер на диск (секунды), сколько строк копить до
+# досрочного сброса и сколько дней хранить записи
+JOB_LOG_DB = os.getenv("JOB_LOG_DB", "jobs.sqlite3")
+JOB_LOG_FLUSH_INTERVAL = int(os.getenv("JOB_LOG_FLUSH_INTERVAL", "5"))
+JOB_LOG_BATCH = int(os.getenv("JOB_LOG_BATCH", "200"))
+JOB_LOG_RETENTION_DAYS = int(os.getenv("JOB_LOG_RETENTION_DAYS", "90"))
+
+# Хранилище выгрузок на диске: каталог, сколько версий каждого листа
+# держать и общий предел в MB (пустой SNAPSHOT_DIR - не хранить)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+SNAPSHOT_KEEP_VERSIONS = int(os.getenv("SNAPSHOT_KEEP_VERSIONS", "3"))
+SNAPSHOT_MAX_MB = int(os.getenv("SNAPSHOT_MAX_MB", "200"))
+
+# Где хранить file_id уже загруженных в Telegram файлов
+FILE_ID_STORE = os.getenv("FILE_ID_STORE", "file_ids.json")
+
+# Несколько процессов-обработчиков (WORKERS > 1): входящие обновления
+# делятся между ними по chat_id, а file_id, подписки и индекс выгрузок
+# хранятся в общей базе SQLite (STATE_BACKEND=sqlite). При одном процессе
+# по умолчанию - JSON-файлы. Фоновое обновление листов и рассылки по
+# подпискам делает только обработчик WORKER_INDEX=0
+WORKERS = int(os.getenv("WORKERS", "1"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite" if WORKERS > 1 else "json")
+STATE_DB = os.getenv("STATE_DB", "bot_state.sqlite3")
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+
+# Токен из переменных окружения Render
+TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+
+# Откуда качать выгрузки и куда слать запросы Bot API (подменяются
+# локальными заглушками в benchmark.py)
+EXPORT_BASE_URL = os.getenv("EXPORT_BASE_URL", "https://docs.google.com").rstrip('/')
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+
+# Веб-сервер: порт (Render назначает его через PORT), режим получения
+# обновлений и адрес webhook. На Render адрес берётся из RENDER_EXTERNAL_URL,
+# без адреса бот работает через polling (BOT_MODE=polling - принудительно)
+PORT = int(os.getenv("PORT", "10000"))
+# При WORKERS > 1 обработчик N отдаёт свои /metrics и /debug/stalls на
+# 127.0.0.1:WORKER_METRICS_PORT+N, а главный процесс собирает их к себе
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", str(PORT + 1)))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL", "")
+BOT_MODE = os.getenv("BOT_MODE", "webhook" if WEBHOOK_URL else "polling")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(TOKEN.encode('utf-8')).hexdigest()[:32]
+
+# Логирование
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# ========== МЕТРИКИ (ФОРМАТ PROMETHEUS) ==========
+# Минимальная реализация без prometheus_client: счётчики, gauge и
+# гистограммы с метками, отдаются текстом на /metrics веб-сервера
+METRICS = []
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+class MetricCounter:
+    kind = 'counter'
+    
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        METRICS.append(self)
+    
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+    
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, value
+
+class Gauge(MetricCounter):
+    kind = 'gauge'
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def set(self, value, **labels):
+        self._values[tuple(sorted(labels.items()))] = value
+
+class FunctionMetric:
+    """Значение считается в момент запроса /metrics (например, счётчики кэша)"""
+    
+    def __init__(self, name, help_text, kind, func):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.func = func
+        METRICS.append(self)
+    
+    def samples(self):
+        yield self.name, (), self.func()
+
+class Histogram:
+    kind = 'histogram'
+    
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}  # метки -> [счётчики по бакетам, сумма, количество]
+        METRICS.append(self)
+    
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+    
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+    
+    def samples(self):
+        for key, (counts, total, count) in self._series.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", key + (('le', str(bound)),), bucket_count
+            yield f"{self.name}_bucket", key + (('le', '+Inf'),), count
+            yield f"{self.name}_sum", key, total
+            yield f"{self.name}_count", key, count
+
+def collect_metrics():
+    """Метрики процесса: [(имя, описание, тип, [(ряд, метки, значение), ...]), ...]"""
+    return [(metric.name, metric.help_text, metric.kind, list(metric.samples())) for metric in METRICS]
+
+def render_metrics(families=None):
+    lines = []
+    for name, help_text, kind, samples in collect_metrics() if families is None else families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample, labels, value in samples:
+            lines.append(f"{sample}{_format_labels(labels)} {value}")
+    return '\n'.join(lines) + '\n'
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+FETCH_SECONDS = Histogram('sheet_fetch_seconds', 'Google export fetch time per spreadsheet and gid', LATENCY_BUCKETS)
+UPLOAD_SECONDS = Histogram('telegram_upload_seconds', 'Telegram sendDocument upload time', LATENCY_BUCKETS)
+DOWNLOAD_SECONDS = Histogram('download_request_seconds', 'End-to-end download request time by mode', LATENCY_BUCKETS)
+LOOP_LAG_SECONDS = Histogram('event_loop_lag_seconds', 'Asyncio event loop scheduling lag', (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+FETCHED_BYTES = MetricCounter('sheet_fetched_bytes_total', 'Bytes downloaded from Google exports')
+UPLOADED_BYTES = MetricCounter('telegram_uploaded_bytes_total', 'Bytes uploaded to Telegram')
+INDEX_BUILD_SECONDS = Histogram('sheet_index_build_seconds', 'Time to parse a snapshot into a lookup index', LATENCY_BUCKETS)
+FETCH_RETRIES_TOTAL = MetricCounter('sheet_fetch_retries_total', 'Google export fetches retried after a transient error, per spreadsheet')
+FETCHES_IN_FLIGHT = Gauge('sheet_fetches_in_flight', 'Google export fetches in progress')
+FunctionMetric('downloads_in_flight', 'Download requests in progress', 'gauge', lambda: len(outbound.active_jobs))
+FunctionMetric('export_cache_hits_total', 'Export cache hits', 'counter', lambda: export_cache.hits)
+FunctionMetric('export_cache_misses_total', 'Export cache misses', 'counter', lambda: export_cache.misses)
+FunctionMetric('export_cache_coalesced_total', 'Requests that joined an in-flight fetch', 'counter', lambda: export_cache.coalesced)
+FunctionMetric('export_cache_not_modified_total', 'Revalidations that found the sheet unchanged', 'counter', lambda: export_cache.not_modified)
+FunctionMetric('export_cache_stale_served_total', 'Requests answered with a stale snapshot', 'counter', lambda: export_cache.stale_served)
+FunctionMetric('sheet_circuits_open', 'Spreadsheets whose circuit breaker is open', 'gauge', lambda: sum(breaker.is_open for breaker in breakers.values()))
+FunctionMetric('export_cache_bytes', 'Export cache size held in memory', 'gauge', lambda: export_cache.size)
+FunctionMetric('export_cache_disk_bytes', 'Export cache size held in temporary files', 'gauge', lambda: export_cache.disk_size)
+FunctionMetric('sheet_indexes', 'Parsed snapshot indexes held in memory', 'gauge', lambda: len(sheet_indexes))
+FunctionMetric('sheet_index_bytes', 'Approximate memory held by parsed snapshot indexes', 'gauge', lambda: sheet_indexes.nbytes)
+FunctionMetric('process_rss_bytes', 'Resident memory at the last sample', 'gauge', lambda: (memory_governor.rss_mb or 0) * 1024 * 1024)
+FunctionMetric('memory_overloaded', '1 while new downloads are refused for memory', 'gauge', lambda: int(memory_governor.overloaded))
+FunctionMetric('memory_cache_sheds_total', 'Times caches were shed under memory pressure', 'counter', lambda: memory_governor.shed_count)
+FunctionMetric('telegram_flood_retries_total', 'Sends retried after RetryAfter', 'counter', lambda: outbound.retries)
+
+async def monitor_event_loop_lag(interval=0.1):
+    """Измеряет, насколько позже запланированного просыпается event loop,
+    и заодно служит сердцебиением для LoopWatchdog"""
+    loop_watchdog.attach()
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - started - interval))
+        loop_watchdog.beat()
+
+# ========== ДИАГНОСТИКА EVENT LOOP ==========
+def format_thread_stack(thread_id):
+    """Текущий стек потока thread_id (как в traceback)"""
+    frame = sys._current_frames().get(thread_id)
+    if frame is None:
+        return ''
+    return ''.join(traceback.format_stack(frame))
+
+class LoopWatchdog:
+    """Сторожевой поток: если event loop не отвечает дольше STALL_THRESHOLD,
+    снимает стек потока loop-а (то, что его блокирует) и пишет в лог.
+    Последние зависания доступны на /debug/stalls веб-сервера."""
+    
+    def __init__(self, threshold, history=20):
+        self.threshold = threshold
+        self.stalls = deque(maxlen=history)
+        self.loop_thread_id = None
+        self.last_beat = time.monotonic()
+        self._current = None
+        self._thread = None
+    
+    def attach(self):
+        """Вызывается из event loop: запоминает его поток и запускает сторожа"""
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self._thread.start()
+    
+    def beat(self):
+        self.last_beat = time.monotonic()
+        if self._current is not None:
+            logger.warning(f"🐢 Event loop был заблокирован {self._current['duration']:.2f} с")
+            self._current = None
+    
+    def _watch(self):
+        while True:
+            time.sleep(self.threshold / 4)
+            blocked = time.monotonic() - self.last_beat
+            if blocked < self.threshold:
+                continue
+            if self._current is None:
+                stack = format_thread_stack(self.loop_thread_id)
+                self._current = {'started': datetime.now().isoformat(timespec='seconds'), 'duration': blocked, 'stack': stack}
+                self.stalls.append(self._current)
+                logger.warning(f"🐢 Event loop не отвечает {blocked:.2f} с, блокирует:\n{stack}")
+            else:
+                self._current['duration'] = blocked
+
+loop_watchdog = LoopWatchdog(STALL_THRESHOLD)
+
+class SamplingProfiler:
+    """Семплирующий профайлер потока event loop.
+    
+    Раз в interval снимает стек и считает одинаковые стеки. Результат - в
+    свёрнутом формате ("a;b;c 42"), который понимают flamegraph.pl и speedscope.
+    """
+    
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+    
+    def run(self, seconds):
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+    
+    def folded(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+# ========== РЕЕСТР ТАБЛИЦ ==========
+# Какие таблицы и листы обслуживает бот и какому чату что доступно.
+# Описывается в JSON-файле SHEETS_CONFIG (пример - sheets.example.json);
+# без файла бот работает со встроенной таблицей SPREADSHEET_ID/SHEETS.
+# Файл читается при первом обращении и перечитывается, когда меняется.
+@dataclass(frozen=True)
+class SheetSpec:
+    """Один лист: таблица, gid, шаблон имени файла ({name}, {date}),
+    колонка с датой для /download <лист> since <дата> и колонки для /find,
+    которые индексируются заранее"""
+    dataset: str
+    spreadsheet_id: str
+    name: str
+    gid: str
+    filename_template: str = "{name}.csv"
+    date_column: str = None
+    key_columns: tuple = ()
+    
+    @property
+    def key(self):
+        return (self.spreadsheet_id, self.gid)
+    
+    def filename(self):
+        return self.filename_template.format(name=self.name, date=datetime.now().strftime("%Y-%m-%d_%H-%M"))
+
+@dataclass(frozen=True)
+class Dataset:
+    """Одна таблица Google Sheets и её листы"""
+    name: str
+    title: str
+    spreadsheet_id: str
+    sheets: tuple
+    archive_name: str
+
+def parse_sheets_config(raw):
+    """Разбирает JSON-конфиг в (таблицы, доступ по умолчанию, доступ по чатам)"""
+    datasets = {}
+    for name, spec in raw['datasets'].items():
+        default_template = spec.get('filename', "{name}.csv")
+        sheets = []
+        for sheet_name, sheet in spec['sheets'].items():
+            if isinstance(sheet, str):
+                sheet = {'gid': sheet}
+            sheets.append(SheetSpec(
+                dataset=name,
+                spreadsheet_id=spec['spreadsheet_id'],
+                name=sheet_name,
+                gid=str(sheet['gid']),
+                filename_template=sheet.get('filename', default_template),
+                date_column=sheet.get('date_column'),
+                key_columns=tuple(sheet.get('key_columns', ())),
+            ))
+        title = spec.get('title', name)
+        datasets[name] = Dataset(name, title, spec['spreadsheet_id'], tuple(sheets), spec.get('archive_name', f"{title}.zip"))
+    
+    access = raw.get('access', {})
+    default_access = tuple(access.get('default', datasets))
+    chat_access = {int(chat_id): tuple(names) for chat_id, names in access.get('chats', {}).items()}
+    for names in (default_access, *chat_access.values()):
+        unknown = set(names) - set(datasets)
+        if unknown:
+            raise ValueError(f"неизвестные таблицы в access: {', '.join(sorted(unknown))}")
+    return datasets, default_access, chat_access
+
+BUILTIN_SHEETS_CONFIG = {
+    'datasets': {
+        'shield': {
+            'title': "Платежный Щит",
+            'spreadsheet_id': SPREADSHEET_ID,
+            'sheets': {
+                "Список_карт_номиналов": {'gid': SHEETS["Список_карт_номиналов"], 'filename': "Список карт номиналов.csv"},
+                "Список_номеров_СБП": {'gid': SHEETS["Список_номеров_СБП"], 'filename': "Список номеров СБП.csv"},
+            },
+        },
+    },
+}
+
+class SheetRegistry:
+    """Конфигурация таблиц с ленивой загрузкой и горячей перезагрузкой"""
+    
+    def __init__(self, path, reload_interval):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._config = None
+        self._mtime = None
+        self._checked_at = 0.0
+        self.version = 0
+    
+    def _current(self):
+        now = time.monotonic()
+        if self._config is None or now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            self._reload_if_changed()
+        return self._config
+    
+    def _reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            mtime = None
+        if self._config is not None and mtime == self._mtime:
+            return
+        
+        try:
+            if mtime is None:
+                raw = BUILTIN_SHEETS_CONFIG
+            else:
+                with open(self.path, encoding='utf-8') as f:
+                    raw = json.load(f)
+            config = parse_sheets_config(raw)
+        except Exception as e:
+            if self._config is None:
+                raise
+            # Битый файл не должен ронять работающего бота - остаёмся на старом конфиге
+            logger.error(f"❌ Не удалось перечитать {self.path}, оставляем прежний конфиг: {e}")
+            self._mtime = mtime
+            return
+        
+        self._config = config
+        self._mtime = mtime
+        self.version += 1
+        source = self.path if mtime is not None else "встроенные настройки"
+        logger.info(f"📋 Загружен реестр таблиц ({source}): {', '.join(config[0])}")
+    
+    def datasets(self):
+        return self._current()[0]
+    
+    def datasets_for_chat(self, chat_id):
+        datasets, default_access, chat_access = self._current()
+        return [datasets[name] for name in chat_access.get(chat_id, default_access)]
+    
+    def sheets_for_chat(self, chat_id):
+        return [sheet for dataset in self.datasets_for_chat(chat_id) for sheet in dataset.sheets]
+    
+    def all_sheets(self):
+        return [sheet for dataset in self.datasets().values() for sheet in dataset.sheets]
+    
+    def find_sheet(self, chat_id, name):
+        """Лист чата по имени: "Список_номеров_СБП", "список номеров сбп" или имя файла"""
+        wanted = normalize_sheet_name(name)
+        for sheet in self.sheets_for_chat(chat_id):
+            if wanted in (normalize_sheet_name(sheet.name), normalize_sheet_name(os.path.splitext(sheet.filename_template)[0])):
+                return sheet
+        return None
+
+def normalize_sheet_name(name):
+    return ' '.join(name.replace('_', ' ').split()).casefold()
+
+sheet_registry = SheetRegistry(SHEETS_CONFIG, CONFIG_RELOAD_INTERVAL)
+
+# ========== АСИНХРОННЫЙ HTTP КЛИЕНТ ==========
+# Один общий пул соединений на весь процесс: keep-alive к Google между
+# запросами и HTTP/2, если установлен пакет h2
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+
+_http_client = None
+
+def get_http_client():
+    """Возвращает общий httpx.AsyncClient (создаётся при первом вызове)"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        load_dependencies()
+        _http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            follow_redirects=True,  # export отвечает редиректом на googleusercontent
+        )
+    return _http_client
+
+async def close_http_client(application=None):
+    """Закрывает пул соединений при остановке бота"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+fetch_semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+
+@dataclass
+class Snapshot:
+    """Скачанная выгрузка листа и её валидаторы для условных запросов.
+    
+    Небольшие выгрузки лежат в памяти (data), крупные - во временном файле
+    (path), который удаляется, когда на снимок больше никто не ссылается.
+    Снимки из SnapshotStore (persistent) лежат в хранилище, не удаляются
+    и читаются через mmap.
+    """
+    sha256: str
+    size: int
+    etag: str | None
+    last_modified: str | None
+    fetched_at: float
+    data: bytes | None = None
+    path: str | None = None
+    persistent: bool = False
+    
+    def __post_init__(self):
+        if self.path is not None and not self.persistent:
+            weakref.finalize(self, _remove_file, self.path)
+    
+    def open(self):
+        """Открывает содержимое снимка для потокового чтения"""
+        if self.data is not None:
+            return io.BytesIO(self.data)
+        if self.persistent:
+            return io.BufferedReader(MappedFile(self.path), DOWNLOAD_CHUNK_SIZE)
+        return open(self.path, 'rb')
+
+class MappedFile(io.RawIOBase):
+    """Файл, читаемый через mmap: страницы берутся из page cache и делятся
+    между всеми читателями, а не копируются в кучу Python целиком"""
+    
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self._pos = 0
+    
+    def readable(self):
+        return True
+    
+    def seekable(self):
+        return True
+    
+    def readinto(self, buffer):
+        chunk = self._map[self._pos:self._pos + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+    
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._map)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+    
+    def tell(self):
+        return self._pos
+    
+    def close(self):
+        if not self.closed and isinstance(self._map, mmap.mmap):
+            self._map.close()
+        super().close()
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def write_json_atomic(path, data):
+    """Пишет JSON во временный файл рядом с path и атомарно подменяет его.
+    
+    Имя временного файла у каждой записи своё, поэтому одновременные записи
+    не мешают друг другу, а при падении на диске остаётся целая старая версия.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except BaseException:
+        _remove_file(tmp_path)
+        raise
+
+class SnapshotWriter:
+    """Принимает выгрузку кусками: считает sha256 на лету и держит в памяти
+    не больше SPOOL_MAX_KB, остальное сбрасывает во временный файл"""
+    
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self._buffer = io.BytesIO()
+        self._file = None
+        self.size = 0
+    
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        if self._file is None and self.size > SPOOL_MAX_KB * 1024:
+            self._file = tempfile.NamedTemporaryFile(prefix='sheet-', suffix='.csv', delete=False)
+            self._file.write(self._buffer.getvalue())
+            self._buffer = None
+        elif self._file is None:
+            self._buffer.write(chunk)
+            return
+        self._file.write(chunk)
+    
+    @property
+    def sha256(self):
+        return self._hash.hexdigest()
+    
+    def finish(self, etag, last_modified):
+        """Закрывает запись и возвращает готовый Snapshot"""
+        if self._file is None:
+            return Snapshot(self.sha256, self.size, etag, last_modified, time.monotonic(), data=self._buffer.getvalue())
+        self._file.close()
+        return Snapshot(self.sha256, self.size, etag, last_modified, time.monotonic(), path=self._file.name)
+    
+    def discard(self):
+        """Выбрасывает записанное (например, если содержимое не изменилось)"""
+        if self._file is not None:
+            self._file.close()
+            _remove_file(self._file.name)
+
+async def fetch_export(url, previous=None):
+    """Скачивает выгрузку листа потоком, не блокируя event loop.
+    
+    Память на один запрос ограничена SPOOL_MAX_KB независимо от размера листа.
+    Если передан previous, запрос условный (If-None-Match / If-Modified-Since).
+    Когда лист не изменился, возвращается previous с обновлённым временем
+    загрузки - по одному и тому же sha256 дальше видно, что данные те же.
+    """
+    headers = {}
+    if previous is not None:
+        if previous.etag:
+            headers['If-None-Match'] = previous.etag
+        if previous.last_modified:
+            headers['If-Modified-Since'] = previous.last_modified
+    
+    async with get_http_client().stream('GET', url, headers=headers) as response:
+        if response.status_code == 304 and previous is not None:
+            previous.fetched_at = time.monotonic()
+            return previous
+        response.raise_for_status()
+        
+        writer = SnapshotWriter()
+        try:
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                writer.write(chunk)
+        except BaseException:
+            writer.discard()
+            raise
+        finally:
+            FETCHED_BYTES.inc(writer.size)
+    
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if previous is not None and previous.sha256 == writer.sha256:
+        # Google часто не отдаёт валидаторы - сравниваем по хэшу содержимого
+        writer.discard()
+        previous.etag = etag
+        previous.last_modified = last_modified
+        previous.fetched_at = time.monotonic()
+        return previous
+    return writer.finish(etag, last_modified)
+
+class CircuitOpenError(Exception):
+    """Запрос к таблице не отправлен: размыкатель открыт после серии ошибок"""
+
+class CircuitBreaker:
+    """Размыкатель для одной таблицы.
+    
+    После threshold ошибок подряд (closed -> open) запросы отклоняются сразу,
+    не нагружая Google. Через cooldown секунд пропускается один пробный
+    запрос (half-open): удачный замыкает цепь, неудачный открывает снова.
+    """
+    
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+    
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+    
+    def before_request(self):
+        if self.opened_at is None:
+            return
+        retry_in = self.opened_at + self.cooldown - time.monotonic()
+        if retry_in > 0 or self._probing:
+            raise CircuitOpenError(f"Google недоступен, повтор через {max(retry_in, 1):.0f} с")
+        self._probing = True
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+    
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.threshold or self.opened_at is not None:
+            if self.opened_at is None:
+                logger.warning(f"⚡ Размыкатель открыт после {self.failures} ошибок подряд")
+            self.opened_at = time.monotonic()
+
+breakers = {}  # spreadsheet_id -> CircuitBreaker
+
+def get_breaker(spreadsheet_id):
+    breaker = breakers.get(spreadsheet_id)
+    if breaker is None:
+        breaker = breakers[spreadsheet_id] = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+    return breaker
+
+def is_retryable(error):
+    """Сетевые ошибки, таймауты, 429 и 5xx стоит повторить; остальное (404, 400) - нет"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
+
+async def download_sheet(spreadsheet_id, gid, previous=None):
+    """Скачивает CSV одного листа (не больше FETCH_CONCURRENCY выгрузок одновременно).
+    
+    Временные ошибки повторяются до FETCH_RETRIES раз с паузой, растущей
+    вдвое, и случайным разбросом - чтобы повторы разных листов не шли
+    волной. Размыкатель таблицы учитывает одну ошибку на выгрузку - когда
+    повторы исчерпаны, а не на каждую попытку: иначе короткий сбой при
+    выгрузке пары листов открывал бы его для всей таблицы.
+    """
+    url = f"{EXPORT_BASE_URL}/spreadsheets/d/{spreadsheet_id}/export?format=csv&gid={gid}"
+    breaker = get_breaker(spreadsheet_id)
+    for attempt in range(FETCH_RETRIES + 1):
+        breaker.before_request()
+        try:
+            async with fetch_semaphore:
+                FETCHES_IN_FLIGHT.inc()
+                try:
+                    # gid повторяются в разных таблицах (у первого листа всегда 0)
+                    with FETCH_SECONDS.time(spreadsheet_id=spreadsheet_id, gid=gid):
+                        snapshot = await fetch_export(url, previous)
+                finally:
+                    FETCHES_IN_FLIGHT.dec()
+        except Exception as e:
+            if not is_retryable(e):
+                breaker.record_success()  # Google ответил - с доступностью всё в порядке
+                raise
+            # Пробный запрос (half-open) не повторяем - он решает судьбу размыкателя
+            if attempt == FETCH_RETRIES or breaker.is_open:
+                breaker.record_failure()
+                raise
+            FETCH_RETRIES_TOTAL.inc(spreadsheet_id=spreadsheet_id)
+            delay = FETCH_RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning(f"Выгрузка {spreadsheet_id}:{gid} не удалась ({e!r}), повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return snapshot
+
+# ========== ОБЩЕЕ СОСТОЯНИЕ ПРОЦЕССОВ (SQLITE) ==========
+class SqliteState:
+    """Ключ-значение в SQLite для состояния, общего у нескольких процессов.
+    
+    Значения - JSON. У каждого потока своё соединение (SQLite не любит
+    делить их между потоками), журнал WAL - чтение не ждёт записи.
+    Запросы короткие, по первичному ключу.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+    
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "namespace TEXT, key TEXT, value TEXT, updated_at REAL, "
+                "PRIMARY KEY (namespace, key))"
+            )
+            self._local.connection = connection
+        return connection
+    
+    @contextmanager
+    def transaction(self):
+        """Чтение-изменение-запись без гонок с другими процессами"""
+        connection = self._connection()
+        if connection.in_transaction:
+            yield
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    
+    def get(self, namespace, key):
+        row = self._connection().execute(
+            "SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def items(self, namespace):
+        rows = self._connection().execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,))
+        return [(key, json.loads(value)) for key, value in rows]
+    
+    def put(self, namespace, key, value):
+        self._connection().execute(
+            "INSERT OR REPLACE INTO state (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value, ensure_ascii=False), time.time()),
+        )
+    
+    def delete(self, namespace, key):
+        return self._connection().execute(
+            "DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key)
+        ).rowcount > 0
+    
+    def prune(self, namespace, keep):
+        """Оставляет keep последних обновлённых ключей"""
+        self._connection().execute(
+            "DELETE FROM state WHERE namespace = ? AND key NOT IN "
+            "(SELECT key FROM state WHERE namespace = ? ORDER BY updated_at DESC LIMIT ?)",
+            (namespace, namespace, keep),
+        )
+
+shared_state = SqliteState(STATE_DB) if STATE_BACKEND == 'sqlite' else None
+
+# ========== ХРАНИЛИЩЕ ВЫГРУЗОК НА ДИСКЕ ==========
+class SnapshotStore:
+    """Выгрузки на диске по содержимому: SNAPSHOT_DIR/<sha256>.csv.
+    
+    index.json помнит последние keep_versions версий каждого листа с их
+    валидаторами. После перезапуска кэш поднимается отсюда, и первый
+    пользователь получает файл сразу, а не ждёт Google. Сверх max_bytes
+    удаляются самые старые версии (последняя версия листа - никогда).
+    Методы синхронные - вызываются через asyncio.to_thread.
+    """
+    
+    def __init__(self, directory, keep_versions, max_bytes):
+        self.directory = directory
+        self.keep_versions = keep_versions
+        self.max_bytes = max_bytes
+        self._index = None  # "spreadsheet_id:gid" -> [версии, новые первыми]
+        self._lock = threading.Lock()
+    
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, 'index.json')
+    
+    def _path(self, sha256):
+        return os.path.join(self.directory, f"{sha256}.csv")
+    
+    def _load(self):
+        if self._index is None:
+            try:
+                with open(self.index_path, encoding='utf-8') as f:
+                    self._index = json.load(f)
+            except FileNotFoundError:
+                self._index = {}
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать {self.index_path}: {e}")
+                self._index = {}
+        return self._index
+    
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+    
+    def _snapshot(self, version):
+        # fetched_at - по времени последней проверки у Google, чтобы возраст
+        # версии был честным (и другой процесс мог понять, свежая ли она)
+        checked_at = version.get('checked_at', version['saved_at'])
+        fetched_at = time.monotonic() - max(0.0, time.time() - checked_at)
+        return Snapshot(
+            version['sha256'], version['size'], version.get('etag'), version.get('last_modified'),
+            fetched_at, path=self._path(version['sha256']), persistent=True,
+        )
+    
+    def save(self, key, snapshot):
+        """Кладёт снимок в хранилище и возвращает его же, но читаемый из хранилища"""
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(snapshot.sha256)
+            if not os.path.exists(path):
+                tmp_path = f"{path}.tmp"
+                _remove_file(tmp_path)
+                if snapshot.data is not None:
+                    with open(tmp_path, 'wb') as f:
+                        f.write(snapshot.data)
+                else:
+                    try:
+                        os.link(snapshot.path, tmp_path)  # Без копирования, если тот же диск
+                    except OSError:
+                        shutil.copyfile(snapshot.path, tmp_path)
+                os.replace(tmp_path, path)
+            
+            version = {
+                'sha256': snapshot.sha256,
+                'size': snapshot.size,
+                'etag': snapshot.etag,
+                'last_modified': snapshot.last_modified,
+                'saved_at': time.time(),
+                'checked_at': time.time(),
+            }
+            index = self._load()
+            name = ':'.join(key)
+            versions = [v for v in index.get(name, []) if v['sha256'] != snapshot.sha256]
+            index[name] = [version] + versions[:self.keep_versions - 1]
+            self._enforce_limits()
+            self._save_index()
+        
+        stored = self._snapshot(version)
+        stored.fetched_at = snapshot.fetched_at
+        return stored
+    
+    def _enforce_limits(self):
+        index = self._index
+        old = sorted(
+            ((v['saved_at'], name, v) for name, versions in index.items() for v in versions[1:]),
+            key=lambda item: item[0],
+        )
+        total = sum(v['size'] for versions in index.values() for v in versions)
+        for saved_at, name, version in old:
+            if total <= self.max_bytes:
+                break
+            index[name].remove(version)
+            total -= version['size']
+        
+        # Удаляем файлы, на которые больше не ссылается ни один лист. Совсем
+        # свежие не трогаем: их мог только что записать другой процесс
+        referenced = {f"{v['sha256']}.csv" for versions in index.values() for v in versions}
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            if filename.endswith('.csv') and filename not in referenced and os.path.getmtime(path) < time.time() - 60:
+                _remove_file(path)
+    
+    def touch(self, key, sha256):
+        """Отмечает, что Google подтвердил: последняя версия листа не изменилась"""
+        with self._lock:
+            versions = self._load().get(':'.join(key))
+            if versions and versions[0]['sha256'] == sha256:
+                versions[0]['checked_at'] = time.time()
+                self._save_index()
+    
+    def latest(self, key):
+        """Последняя сохранённая версия листа или None"""
+        with self._lock:
+            versions = self._load().get(':'.join(key))
+            if not versions or not os.path.exists(self._path(versions[0]['sha256'])):
+                return None
+            return self._snapshot(versions[0])
+    
+    def restore(self):
+        """Последние версии всех листов: [(ключ, снимок)] - для прогрева кэша при старте"""
+        with self._lock:
+            names = list(self._load())
+        restored = []
+        for name in names:
+            key = tuple(name.split(':', 1))
+            snapshot = self.latest(key)
+            if snapshot is not None:
+                restored.append((key, snapshot))
+        return restored
+
+class SharedSnapshotStore(SnapshotStore):
+    """SnapshotStore, у которого индекс версий лежит в SqliteState, а не в
+    index.json: его видят и меняют все процессы-обработчики"""
+    
+    namespace = 'snapshots'
+    
+    def __init__(self, state, directory, keep_versions, max_bytes):
+        super().__init__(directory, keep_versions, max_bytes)
+        self.state = state
+    
+    def _load(self):
+        # Каждый раз читаем заново: индекс мог изменить другой процесс
+        self._index = dict(self.state.items(self.namespace))
+        return self._index
+    
+    def _save_index(self):
+        stored = {key for key, versions in self.state.items(self.namespace)}
+        for key, versions in self._index.items():
+            self.state.put(self.namespace, key, versions)
+        for key in stored - set(self._index):
+            self.state.delete(self.namespace, key)
+    
+    def save(self, key, snapshot):
+        with self.state.transaction():
+            return super().save(key, snapshot)
+    
+    def touch(self, key, sha256):
+        with self.state.transaction():
+            super().touch(key, sha256)
+
+if not SNAPSHOT_DIR:
+    snapshot_store = None
+elif shared_state is not None:
+    snapshot_store = SharedSnapshotStore(shared_state, SNAPSHOT_DIR, SNAPSHOT_KEEP_VERSIONS, SNAPSHOT_MAX_MB * 1024 * 1024)
+else:
+    snapshot_store = SnapshotStore(SNAPSHOT_DIR, SNAPSHOT_KEEP_VERSIONS, SNAPSHOT_MAX_MB * 1024 * 1024)
+
+# ========== КЭШ ВЫГРУЗОК ==========
+class ExportCache:
+    """LRU-кэш выгрузок по (spreadsheet_id, gid) с TTL.
+    
+    Одновременные запросы одного листа ждут одну и ту же загрузку
+    (single-flight), а не качают его из Google каждый сам. Устаревшая
+    запись перепроверяется условным запросом, а не скачивается заново.
+    Новые версии сохраняются в store (если задан); лист, вытесненный из
+    кэша, перепроверяется относительно версии из store.
+    
+    Stale-while-revalidate: если устаревшая запись есть, а обновление не
+    уложилось в budget секунд или упало, отдаётся устаревшая запись
+    (is_stale() покажет это), а обновление продолжает идти в фоне.
+    
+    Память (max_bytes, size) считается только по снимкам в памяти (data).
+    Снимки во временных файлах ограничены отдельно (max_disk_bytes,
+    disk_size), а снимки из store лежат в хранилище с его собственным
+    пределом и не считаются вовсе: их вытеснение не освобождает память.
+    """
+    
+    def __init__(self, loader, ttl, max_bytes, store=None, budget=None, max_disk_bytes=0):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.store = store
+        self.budget = budget
+        self._entries = OrderedDict()  # (spreadsheet_id, gid) -> Snapshot
+        self._inflight = {}  # (spreadsheet_id, gid) -> asyncio.Task
+        self.size = 0
+        self.disk_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.not_modified = 0
+        self.stale_served = 0
+    
+    def is_stale(self, snapshot):
+        return time.monotonic() - snapshot.fetched_at >= self.ttl
+    
+    async def get(self, spreadsheet_id, gid):
+        key = (spreadsheet_id, gid)
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.fetched_at < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        
+        if key in self._inflight:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+        if entry is None:
+            return await self._join(key)
+        
+        try:
+            return await asyncio.wait_for(self._join(key), self.budget)
+        except Exception as e:
+            # wait_for отменяет только ожидание - сама загрузка под shield идёт дальше
+            self.stale_served += 1
+            logger.warning(f"Отдаём устаревшую версию {key}: {e!r}")
+            return entry
+    
+    def peek(self, spreadsheet_id, gid):
+        """Текущая запись без загрузки и без учёта TTL"""
+        return self._entries.get((spreadsheet_id, gid))
+    
+    async def refresh(self, spreadsheet_id, gid):
+        """Перепроверяет лист, даже если запись ещё свежая (для фонового обновления)"""
+        return await self._join((spreadsheet_id, gid), revalidate=True)
+    
+    async def _join(self, key, revalidate=False):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._load(key, self._entries.get(key), revalidate))
+            # Ошибку забирают ожидающие; если все ушли по budget - забираем сами
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+            self._inflight[key] = task
+        # shield: отмена одного ожидающего не отменяет общую загрузку
+        return await asyncio.shield(task)
+    
+    async def _load(self, key, previous, revalidate=False):
+        try:
+            stored = None
+            if self.store is not None:
+                stored = await asyncio.to_thread(self.store.latest, key)
+                if stored is not None and not revalidate and not self.is_stale(stored):
+                    # Другой процесс только что проверил лист - в Google не ходим
+                    self._put(key, stored)
+                    return stored
+                if previous is None:
+                    previous = stored
+                else:
+                    stored = None
+            try:
+                snapshot = await self.loader(*key, previous=previous)
+            except Exception:
+                if stored is None:
+                    raise
+                # Google недоступен, а версия на диске есть - отдаём её как устаревшую
+                stored.fetched_at = min(stored.fetched_at, time.monotonic() - self.ttl)
+                self.stale_served += 1
+                self._put(key, stored)
+                return stored
+            if previous is not None and snapshot.sha256 == previous.sha256:
+                self.not_modified += 1
+                if self.store is not None:
+                    try:
+                        await asyncio.to_thread(self.store.touch, key, snapshot.sha256)
+                    except Exception as e:
+                        logger.warning(f"Не удалось отметить проверку {key}: {e}")
+            elif self.store is not None:
+                try:
+                    snapshot = await asyncio.to_thread(self.store.save, key, snapshot)
+                except Exception as e:
+                    logger.warning(f"Не удалось сохранить выгрузку {key} на диск: {e}")
+            self._put(key, snapshot)
+            return snapshot
+        finally:
+            self._inflight.pop(key, None)
+    
+    @staticmethod
+    def _in_memory(snapshot):
+        return snapshot.data is not None
+    
+    @staticmethod
+    def _spooled(snapshot):
+        return snapshot.data is None and not snapshot.persistent
+    
+    def _put(self, key, snapshot):
+        self._drop(key)
+        if self._in_memory(snapshot) and snapshot.size > self.max_bytes:
+            return  # Слишком большой лист не кэшируем
+        if self._spooled(snapshot) and snapshot.size > self.max_disk_bytes:
+            return
+        self._entries[key] = snapshot
+        self._account(snapshot, 1)
+        while self.size > self.max_bytes:
+            self._drop_oldest(self._in_memory)
+        while self.disk_size > self.max_disk_bytes:
+            self._drop_oldest(self._spooled)
+    
+    async def restore(self):
+        """Поднимает кэш из store после перезапуска. Возраст снимков честный
+        (по последней проверке у Google): давний снимок - устаревший, первый
+        запрос перепроверит его, а если Google не уложится в budget - получит
+        его с пометкой об устаревании"""
+        if self.store is None:
+            return 0
+        restored = await asyncio.to_thread(self.store.restore)
+        for key, snapshot in restored:
+            if key not in self._entries:
+                self._put(key, snapshot)
+        return len(restored)
+    
+    def shrink(self, fraction):
+        """Выбрасывает самые старые записи в памяти, пока их объём не
+        уменьшится на долю fraction (файлы на диске памяти не занимают)"""
+        target = self.size * (1 - fraction)
+        while self.size > target:
+            self._drop_oldest(self._in_memory)
+    
+    def _account(self, snapshot, sign):
+        if self._in_memory(snapshot):
+            self.size += sign * snapshot.size
+        elif self._spooled(snapshot):
+            self.disk_size += sign * snapshot.size
+    
+    def _drop_oldest(self, matches):
+        key = next(key for key, entry in self._entries.items() if matches(entry))
+        self._drop(key)
+    
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._account(entry, -1)
+
+export_cache = ExportCache(
+    download_sheet,
+    ttl=CACHE_TTL,
+    max_bytes=CACHE_MAX_MB * 1024 * 1024,
+    max_disk_bytes=CACHE_DISK_MAX_MB * 1024 * 1024,
+    store=snapshot_store,
+    budget=FETCH_BUDGET,
+)
+
+# ========== ИСХОДЯЩИЕ ЗАПРОСЫ К TELEGRAM ==========
+class TokenBucket:
+    """Ведро токенов: rate запросов в секунду, не больше capacity подряд"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def pause(self, seconds):
+        """Telegram попросил подождать (retry_after) - не тратим токены до этого момента"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    def idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.paused_until
+
+class OutboundScheduler:
+    """Планировщик исходящих вызовов Bot API.
+    
+    Каждый вызов ждёт токен в ведре своего чата и в общем ведре бота, так
+    что мы держимся у лимитов Telegram, а не упираемся в 429. Если 429 всё же
+    пришёл, чат ставится на паузу на retry_after и вызов повторяется.
+    Заодно помнит, в каких чатах уже идёт выгрузка, чтобы не запускать
+    повторную по второму нажатию кнопки.
+    """
+    
+    def __init__(self, global_rate, chat_rate, chat_burst, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+        self.active_jobs = set()
+        self.retries = 0
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 1000:
+                # Забываем чаты, которые давно ничего не получали
+                now = time.monotonic()
+                for idle_chat in [c for c, b in self._chat_buckets.items() if b.idle(now)]:
+                    del self._chat_buckets[idle_chat]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    async def call(self, chat_id, func, /, *args, **kwargs):
+        """Выполняет func(*args, **kwargs) с учётом лимитов чата chat_id"""
+        bucket = self._chat_bucket(chat_id)
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await func(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                logger.warning(f"Flood limit в чате {chat_id}, ждём {e.retry_after} с")
+                bucket.pause(e.retry_after)
+    
+    def begin_job(self, chat_id):
+        """Отмечает начало выгрузки в чате. False - в этом чате выгрузка уже идёт"""
+        if chat_id in self.active_jobs:
+            return False
+        self.active_jobs.add(chat_id)
+        return True
+    
+    def end_job(self, chat_id):
+        self.active_jobs.discard(chat_id)
+
+# При WORKERS > 1 шлют только обработчики, у каждого своё ведро: общий
+# лимит бота делим между ними. Чат всегда в одном обработчике, так что
+# лимит на чат остаётся прежним
+outbound = OutboundScheduler(
+    global_rate=SEND_RATE_GLOBAL / WORKERS,
+    chat_rate=SEND_RATE_CHAT,
+    chat_burst=SEND_BURST_CHAT,
+)
+
+# ========== ПОВТОРНОЕ ИСПОЛЬЗОВАНИЕ FILE_ID ==========
+class FileIdStore:
+    """Хранит file_id Telegram для каждого уже загруженного содержимого.
+    
+    Ключ - sha256 содержимого и имя файла. Словарь сохраняется в JSON,
+    поэтому переживает перезапуски процесса.
+    """
+    
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self._ids = None
+        self._persist_lock = asyncio.Lock()  # Записи по очереди, последней ложится новейшая версия
+    
+    def _load(self):
+        if self._ids is None:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self._ids = json.load(f)
+            except FileNotFoundError:
+                self._ids = {}
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать {self.path}: {e}")
+                self._ids = {}
+        return self._ids
+    
+    async def _persist(self):
+        async with self._persist_lock:
+            try:
+                # Снимок берётся уже под блокировкой - он не старше предыдущей записи
+                await asyncio.to_thread(write_json_atomic, self.path, dict(self._ids))
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить {self.path}: {e}")
+    
+    def get(self, key):
+        return self._load().get(key)
+    
+    async def put(self, key, file_id):
+        ids = self._load()
+        ids.pop(key, None)
+        ids[key] = file_id
+        while len(ids) > self.max_entries:
+            del ids[next(iter(ids))]
+        await self._persist()
+    
+    async def discard(self, key):
+        if self._load().pop(key, None) is not None:
+            await self._persist()
+
+class SharedFileIdStore(FileIdStore):
+    """FileIdStore поверх SqliteState: file_id, загруженный одним процессом,
+    сразу доступен остальным"""
+    
+    namespace = 'file_ids'
+    
+    def __init__(self, state, max_entries=1000):
+        super().__init__(None, max_entries)
+        self.state = state
+        self._ids = {}  # локальная копия уже прочитанных file_id
+    
+    def get(self, key):
+        file_id = self._ids.get(key)
+        if file_id is None:
+            file_id = self.state.get(self.namespace, key)
+            if file_id is not None:
+                self._ids[key] = file_id
+        return file_id
+    
+    def _put(self, key, file_id):
+        self.state.put(self.namespace, key, file_id)
+        self.state.prune(self.namespace, self.max_entries)
+    
+    async def put(self, key, file_id):
+        self._ids[key] = file_id
+        try:
+            await asyncio.to_thread(self._put, key, file_id)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить file_id в {self.state.path}: {e}")
+    
+    async def discard(self, key):
+        self._ids.pop(key, None)
+        try:
+            await asyncio.to_thread(self.state.delete, self.namespace, key)
+        except Exception as e:
+            logger.warning(f"Не удалось удалить file_id из {self.state.path}: {e}")
+
+file_id_store = SharedFileIdStore(shared_state) if shared_state is not None else FileIdStore(FILE_ID_STORE)
+
+def guess_mime_type(filename):
+    mime_type, encoding = mimetypes.guess_type(filename)
+    if encoding == 'gzip':
+        return 'application/gzip'
+    return mime_type or 'application/octet-stream'
+
+async def upload_document(bot, chat_id, snapshot, filename, caption):
+    """Загружает снимок в Telegram потоком (sendDocument через общий httpx-клиент).
+    
+    PTB читает файл в память целиком перед отправкой, поэтому загрузку
+    делаем сами: multipart отдаётся кусками прямо из файла снимка.
+    """
+    with snapshot.open() as document, UPLOAD_SECONDS.time():
+        response = await get_http_client().post(
+            f"{bot.base_url}/sendDocument",
+            data={'chat_id': str(chat_id), 'caption': caption},
+            files={'document': (filename, document, guess_mime_type(filename))},
+            timeout=httpx.Timeout(UPLOAD_TIMEOUT, connect=10.0),
+        )
+    UPLOADED_BYTES.inc(snapshot.size)
+    
+    try:
+        payload = response.json()
+    except ValueError:
+        raise TelegramError(f"Invalid server response ({response.status_code})")
+    if payload.get('ok'):
+        return Message.de_json(payload['result'], bot)
+    
+    description = payload.get('description', 'Unknown error')
+    parameters = payload.get('parameters') or {}
+    if 'retry_after' in parameters:
+        raise RetryAfter(parameters['retry_after'])
+    if response.status_code == 400:
+        raise BadRequest(description)
+    if response.status_code == 403:
+        raise Forbidden(description)
+    raise TelegramError(description)
+
+async def send_known_document(bot, chat_id, sha256, filename, caption):
+    """Пробует отправить файл по сохранённому file_id. Возвращает None, если его нет"""
+    key = f"{sha256}:{filename}"
+    file_id = file_id_store.get(key)
+    if not file_id:
+        return None
+    try:
+        return await outbound.call(chat_id, bot.send_document, chat_id=chat_id, document=file_id, caption=caption)
+    except BadRequest as e:
+        # file_id устарел или принадлежит другому боту - загружаем заново
+        logger.warning(f"file_id для {filename} не принят: {e}")
+        await file_id_store.discard(key)
+        return None
+
+_uploading = {}  # "sha256:filename" -> asyncio.Future, завершается после загрузки
+
+async def send_document_cached(bot, chat_id, snapshot, filename, caption):
+    """Отправляет файл по file_id, если такое содержимое уже загружалось в Telegram.
+    
+    Пока тот же файл загружается в другой чат, ждём эту загрузку и
+    отправляем по её file_id. Если она не удалась, загружает следующий.
+    """
+    key = f"{snapshot.sha256}:{filename}"
+    while True:
+        message = await send_known_document(bot, chat_id, snapshot.sha256, filename, caption)
+        if message is not None:
+            return message
+        pending = _uploading.get(key)
+        if pending is None:
+            break
+        await asyncio.shield(pending)
+    
+    uploaded = asyncio.get_running_loop().create_future()
+    _uploading[key] = uploaded
+    try:
+        message = await outbound.call(chat_id, upload_document, bot, chat_id, snapshot, filename, caption)
+        await file_id_store.put(key, message.document.file_id)
+        return message
+    finally:
+        del _uploading[key]
+        uploaded.set_result(None)
+
+# ========== ПОДПИСКИ НА ОБНОВЛЕНИЯ ==========
+class SubscriptionStore:
+    """Подписчики каждого листа и sha256 последней разосланной им версии.
+    
+    Ключ - "spreadsheet_id:gid". Хранится в JSON, как и file_id, чтобы
+    подписки и "что уже разослано" переживали перезапуски.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._data = None
+        self._persist_lock = asyncio.Lock()
+    
+    def _load(self):
+        if self._data is None:
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self._data = json.load(f)
+            except FileNotFoundError:
+                self._data = {}
+            except Exception as e:
+                logger.warning(f"Не удалось прочитать {self.path}: {e}")
+                self._data = {}
+            self._data.setdefault('subscribers', {})
+            self._data.setdefault('delivered', {})
+        return self._data
+    
+    async def _persist(self):
+        async with self._persist_lock:
+            try:
+                await asyncio.to_thread(write_json_atomic, self.path, json.loads(json.dumps(self._data)))
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить {self.path}: {e}")
+    
+    def subscribers(self, sheet):
+        return list(self._load()['subscribers'].get(':'.join(sheet.key), []))
+    
+    def is_subscribed(self, sheet, chat_id):
+        return chat_id in self._load()['subscribers'].get(':'.join(sheet.key), [])
+    
+    async def subscribe(self, sheets, chat_id):
+        """Подписывает чат на листы, возвращает те, на которые он ещё не был подписан"""
+        added = []
+        for sheet in sheets:
+            chats = self._load()['subscribers'].setdefault(':'.join(sheet.key), [])
+            if chat_id not in chats:
+                chats.append(chat_id)
+                added.append(sheet)
+        if added:
+            await self._persist()
+        return added
+    
+    async def unsubscribe(self, sheets, chat_id):
+        """Отписывает чат от листов (None - от всех), возвращает число отписок"""
+        subscribers = self._load()['subscribers']
+        keys = list(subscribers) if sheets is None else [':'.join(sheet.key) for sheet in sheets]
+        removed = 0
+        for key in keys:
+            chats = subscribers.get(key, [])
+            if chat_id in chats:
+                chats.remove(chat_id)
+                removed += 1
+            if not chats:
+                subscribers.pop(key, None)
+        if removed:
+            await self._persist()
+        return removed
+    
+    def delivered(self, sheet):
+        return self._load()['delivered'].get(':'.join(sheet.key))
+    
+    async def mark_delivered(self, sheet, sha256):
+        self._load()['delivered'][':'.join(sheet.key)] = sha256
+        await self._persist()
+
+class SharedSubscriptionStore(SubscriptionStore):
+    """SubscriptionStore поверх SqliteState: подписаться можно через любой
+    процесс, а рассылает их ведущий. Подписка - отдельный ключ
+    "spreadsheet_id:gid|chat_id", поэтому одновременные подписки не теряются"""
+    
+    def __init__(self, state):
+        super().__init__(None)
+        self.state = state
+    
+    def subscribers(self, sheet):
+        prefix = ':'.join(sheet.key) + '|'
+        return [chat_id for key, chat_id in self.state.items('subscribers') if key.startswith(prefix)]
+    
+    def is_subscribed(self, sheet, chat_id):
+        return self.state.get('subscribers', f"{':'.join(sheet.key)}|{chat_id}") is not None
+    
+    async def subscribe(self, sheets, chat_id):
+        def subscribe():
+            added = []
+            with self.state.transaction():
+                for sheet in sheets:
+                    if not self.is_subscribed(sheet, chat_id):
+                        self.state.put('subscribers', f"{':'.join(sheet.key)}|{chat_id}", chat_id)
+                        added.append(sheet)
+            return added
+        return await asyncio.to_thread(subscribe)
+    
+    async def unsubscribe(self, sheets, chat_id):
+        def unsubscribe():
+            if sheets is None:
+                keys = [key for key, subscriber in self.state.items('subscribers') if subscriber == chat_id]
+            else:
+                keys = [f"{':'.join(sheet.key)}|{chat_id}" for sheet in sheets]
+            with self.state.transaction():
+                return sum(self.state.delete('subscribers', key) for key in keys)
+        return await asyncio.to_thread(unsubscribe)
+    
+    def delivered(self, sheet):
+        return self.state.get('delivered', ':'.join(sheet.key))
+    
+    async def mark_delivered(self, sheet, sha256):
+        await asyncio.to_thread(self.state.put, 'delivered', ':'.join(sheet.key), sha256)
+
+subscription_store = SharedSubscriptionStore(shared_state) if shared_state is not None else SubscriptionStore(SUBSCRIPTIONS_FILE)
+
+async def notify_subscribers(bot, sheet, snapshot):
+    """Рассылает новую версию листа подписчикам: файл загружается в Telegram
+    один раз, остальным он уходит по file_id"""
+    chats = [chat_id for chat_id in subscription_store.subscribers(sheet) if sheet in sheet_registry.sheets_for_chat(chat_id)]
+    if not chats:
+        return
+    filename = sheet.filename()
+    caption = f"🔔 Обновился лист {sheet.name}"
+    
+    # Файл загружается один раз (send_document_cached), остальным - по file_id
+    async def deliver(chat_id):
+        try:
+            await send_document_cached(bot, chat_id, snapshot, filename, caption)
+            return True
+        except Forbidden:
+            # Бота заблокировали или выгнали из чата - подписка больше не нужна
+            logger.info(f"Чат {chat_id} недоступен, отписываем от {sheet.name}")
+            await subscription_store.unsubscribe(None, chat_id)
+        except Exception as e:
+            logger.warning(f"Не удалось отправить обновление {sheet.name} в чат {chat_id}: {e}")
+        return False
+    
+    delivered = sum(await asyncio.gather(*(deliver(chat_id) for chat_id in chats)))
+    logger.info(f"🔔 Обновление {sheet.name} разослано: {delivered} чатов")
+
+# ========== АРХИВЫ ==========
+# Архив собирается потоково из снимков во временный файл (в отдельном
+# потоке, чтобы не блокировать event loop). Его "sha256" - хэш от хэшей
+# содержимого, поэтому неизменившийся архив отправляется по file_id и
+# вообще не пересобирается.
+def derived_sha256(kind, members):
+    """Ключ производного файла: вид упаковки + имена и хэши исходных снимков"""
+    digest = hashlib.sha256(kind.encode('utf-8'))
+    for filename, snapshot in members:
+        digest.update(f"\n{filename}:{snapshot.sha256}".encode('utf-8'))
+    return digest.hexdigest()
+
+def build_zip(members, sha256):
+    """Упаковывает снимки в один zip, копируя их кусками"""
+    with tempfile.NamedTemporaryFile(prefix='sheets-', suffix='.zip', delete=False) as tmp:
+        with zipfile.ZipFile(tmp, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for filename, snapshot in members:
+                with snapshot.open() as src, archive.open(filename, 'w', force_zip64=True) as dst:
+                    shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+        size = tmp.tell()
+    return Snapshot(sha256, size, None, None, time.monotonic(), path=tmp.name)
+
+def build_gzip(filename, snapshot, sha256):
+    """Сжимает один снимок в gzip, копируя его кусками"""
+    with tempfile.NamedTemporaryFile(prefix='sheet-', suffix='.gz', delete=False) as tmp:
+        with snapshot.open() as src, gzip.GzipFile(filename=filename, mode='wb', fileobj=tmp, mtime=0) as dst:
+            shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_SIZE)
+        size = tmp.tell()
+    return Snapshot(sha256, size, None, None, time.monotonic(), path=tmp.name)
+
+_packing = {}  # derived sha256 -> asyncio.Task сборки
+
+def build_packed(kind, members, sha256):
+    if kind == 'zip':
+        return build_zip(members, sha256)
+    return PACKERS[kind](*members[0], sha256)
+
+async def send_packed(bot, chat_id, kind, members, filename, caption):
+    """Отправляет zip/gzip/xlsx/parquet/jsonl: по file_id, если такой файл уже
+    загружался, иначе собирает и загружает. Одновременные запросы одного
+    содержимого ждут одну сборку"""
+    sha256 = derived_sha256(kind, members)
+    message = await send_known_document(bot, chat_id, sha256, filename, caption)
+    if message is not None:
+        return message
+    
+    task = _packing.get(sha256)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(build_packed, kind, members, sha256))
+        # Ошибку забирают ожидающие; если все отменены - забираем сами
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        _packing[sha256] = task
+    try:
+        packed = await asyncio.shield(task)
+        return await send_document_cached(bot, chat_id, packed, filename, caption)
+    finally:
+        # Сборку держим, пока первая отправка не запомнит file_id
+        if _packing.get(sha256) is task:
+            del _packing[sha256]
+
+# ========== ДРУГИЕ ФОРМАТЫ: XLSX, PARQUET, JSONL ==========
+# Конвертируются из снимка CSV построчно во временный файл, так что память
+# не зависит от размера листа. Как и архивы, кэшируются по file_id от хэша
+# снимка: пока лист не изменился, повторный запрос ничего не пересобирает.
+# openpyxl и pyarrow необязательны - без них соответствующий формат скрыт.
+# Сами пакеты импортируются только при первой сборке файла.
+XLSX_AVAILABLE = importlib.util.find_spec('openpyxl') is not None
+PARQUET_AVAILABLE = importlib.util.find_spec('pyarrow') is not None
+
+# Сколько строк собирать в один row group Parquet
+PARQUET_BATCH_ROWS = 65536
+
+@contextmanager
+def read_csv(snapshot):
+    """csv.reader поверх снимка - потоком, без чтения в память целиком"""
+    with snapshot.open() as raw, io.TextIOWrapper(raw, encoding='utf-8-sig', newline='') as text:
+        yield csv.reader(text)
+
+def column_names(header):
+    """Уникальные непустые имена колонок (для ключей JSON и схемы Parquet)"""
+    names = []
+    for i, title in enumerate(header):
+        name = title.strip() or f"column_{i + 1}"
+        while name in names:
+            name += '_'
+        names.append(name)
+    return names
+
+def fit_row(row, width):
+    return row[:width] if len(row) >= width else row + [''] * (width - len(row))
+
+def build_jsonl(filename, snapshot, sha256):
+    """Одна строка листа - один JSON-объект {колонка: значение}"""
+    with read_csv(snapshot) as reader, tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='\n', prefix='sheet-', suffix='.jsonl', delete=False) as tmp:
+        names = column_names(next(reader, []))
+        for row in reader:
+            if any(row):
+                tmp.write(json.dumps(dict(zip(names, fit_row(row, len(names)))), ensure_ascii=False))
+                tmp.write('\n')
+    return Snapshot(sha256, os.path.getsize(tmp.name), None, None, time.monotonic(), path=tmp.name)
+
+def build_xlsx(filename, snapshot, sha256):
+    """XLSX в режиме write_only: строки сразу уходят в файл. Значения
+    остаются текстом, чтобы Excel не портил номера карт и телефонов.
+    Ячейки, начинающиеся с "=", openpyxl записал бы формулой - их
+    записываем явно строкой, чтобы данные листа не исполнялись в Excel"""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    
+    def as_text(value):
+        if not value.startswith('='):
+            return value
+        cell = WriteOnlyCell(worksheet, value=value)
+        cell.data_type = 's'
+        return cell
+    
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(os.path.splitext(filename)[0][:31])
+    with read_csv(snapshot) as reader:
+        for row in reader:
+            worksheet.append([as_text(value) for value in row])
+    with tempfile.NamedTemporaryFile(prefix='sheet-', suffix='.xlsx', delete=False) as tmp:
+        workbook.save(tmp)
+        size = tmp.tell()
+    return Snapshot(sha256, size, None, None, time.monotonic(), path=tmp.name)
+
+def build_parquet(filename, snapshot, sha256):
+    """Parquet со строковыми колонками, по PARQUET_BATCH_ROWS строк на row group"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    with read_csv(snapshot) as reader, tempfile.NamedTemporaryFile(prefix='sheet-', suffix='.parquet', delete=False) as tmp:
+        names = column_names(next(reader, []))
+        schema = pa.schema([(name, pa.string()) for name in names])
+        with pq.ParquetWriter(tmp, schema) as writer:
+            batch = []
+            for row in reader:
+                if any(row):
+                    batch.append(fit_row(row, len(names)))
+                if len(batch) >= PARQUET_BATCH_ROWS:
+                    writer.write_table(pa.Table.from_arrays([pa.array(column, pa.string()) for column in zip(*batch)], schema=schema))
+                    batch = []
+            if batch:
+                writer.write_table(pa.Table.from_arrays([pa.array(column, pa.string()) for column in zip(*batch)], schema=schema))
+        size = tmp.tell()
+    return Snapshot(sha256, size, None, None, time.monotonic(), path=tmp.name)
+
+# Вид упаковки одного листа -> сборщик
+PACKERS = {
+    'gzip': build_gzip,
+    'jsonl': build_jsonl,
+    'xlsx': build_xlsx,
+    'parquet': build_parquet,
+}
+FORMAT_EXTENSIONS = {'jsonl': '.jsonl', 'xlsx': '.xlsx', 'parquet': '.parquet'}
+
+def format_available(mode):
+    return {'xlsx': XLSX_AVAILABLE, 'parquet': PARQUET_AVAILABLE}.get(mode, True)
+
+# ========== ПОИСК ПО ЛИСТАМ ==========
+# Снимок листа разбирается один раз (по sha256) и дальше все /find и
+# срезы по дате идут по готовому индексу, а не по тексту CSV
+DATE_FORMATS = ("%d.%m.%Y", "%Y-%m-%d", "%d/%m/%Y", "%d.%m.%y")
+DIGITS_ONLY = re.compile(r"[\d\s()+-]+")
+# Колонки, которые индексируются сразу при разборе снимка (если у листа
+# в конфиге не задан key_columns)
+KEY_COLUMN_HINTS = ('карт', 'телефон', 'номер', 'card', 'phone')
+
+def normalize_value(value):
+    """Ключ для поиска: без регистра и пробелов по краям; номера карт и
+    телефонов - только цифры ("1234 5678" и "12345678" совпадают)"""
+    value = value.strip()
+    if DIGITS_ONLY.fullmatch(value) and any(c.isdigit() for c in value):
+        return ''.join(c for c in value if c.isdigit())
+    return value.casefold()
+
+def parse_date(value):
+    """Дата из ячейки или аргумента команды (время после даты отбрасывается)"""
+    value = value.strip().replace('T', ' ').split(' ', 1)[0]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).date()
+        except ValueError:
+            pass
+    return None
+
+def is_key_column(title):
+    title = title.casefold()
+    return any(hint in title for hint in KEY_COLUMN_HINTS)
+
+class PackedStrings:
+    """Неизменяемый список строк, склеенных в одну: границы лежат в array.
+    Миллион номеров карт - ~23 MB вместо ~75 MB отдельных объектов str"""
+    __slots__ = ('_text', '_offsets')
+    
+    def __init__(self, values):
+        self._text = ''.join(values)
+        self._offsets = array('I' if len(self._text) < 2 ** 32 else 'Q', accumulate(map(len, values), initial=0))
+    
+    def __len__(self):
+        return len(self._offsets) - 1
+    
+    def __getitem__(self, i):
+        return self._text[self._offsets[i]:self._offsets[i + 1]]
+    
+    def __iter__(self):
+        return map(self.__getitem__, range(len(self)))
+    
+    @property
+    def nbytes(self):
+        return sys.getsizeof(self._text) + sys.getsizeof(self._offsets)
+
+class Column:
+    """Колонка со словарным кодированием: различные значения хранятся один
+    раз (после разбора - PackedStrings), а строки - номерами значений в
+    array('I') (4 байта на ячейку)"""
+    __slots__ = ('values', 'codes')
+    
+    def __init__(self):
+        self.values = []
+        self.codes = array('I')
+    
+    @property
+    def nbytes(self):
+        return self.values.nbytes + sys.getsizeof(self.codes)
+
+class KeyLookup:
+    """Хэш-индекс колонки без словаря на миллион ключей.
+    
+    Хэши нормализованных значений отсортированы в array('q') (рядом - коды
+    значений), номера строк лежат подряд, сгруппированные по коду (offsets +
+    rows, как в CSR-матрице). ~20 байт на различное значение вместо ~100 у
+    dict с объектами int; совпадение хэша проверяется сравнением значений.
+    """
+    __slots__ = ('column', 'hashes', 'codes', 'offsets', 'rows')
+    
+    def __init__(self, column, row_count):
+        self.column = column
+        hashes = [hash(normalize_value(value)) for value in column.values]  # код -> хэш
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        self.hashes = array('q', [hashes[code] for code in order])
+        self.codes = array('I', order)
+        del hashes, order
+        counts = array('I', [0]) * (len(column.values) + 1)
+        for code in column.codes:
+            counts[code + 1] += 1
+        self.offsets = array('I', accumulate(counts))
+        # Сортировка устойчивая - внутри кода строки идут по возрастанию
+        self.rows = array('I', sorted(range(row_count), key=column.codes.__getitem__))
+    
+    def find(self, value):
+        key = normalize_value(value)
+        digest = hash(key)
+        i = bisect.bisect_left(self.hashes, digest)
+        found = []
+        while i < len(self.hashes) and self.hashes[i] == digest:
+            code = self.codes[i]
+            if normalize_value(self.column.values[code]) == key:
+                found.append(self.rows[self.offsets[code]:self.offsets[code + 1]])
+            i += 1
+        # Несколько кодов - разное написание одного ключа ("1234 5678" и "12345678")
+        return found[0] if len(found) == 1 else sorted(n for numbers in found for n in numbers)
+    
+    @property
+    def nbytes(self):
+        return sum(sys.getsizeof(part) for part in (self.hashes, self.codes, self.offsets, self.rows))
+
+class SheetIndex:
+    """Разобранный снимок листа в колоночном виде и хэш-индексы по колонкам.
+    
+    Ключевые колонки (номер карты, телефон - KEY_COLUMN_HINTS или key_columns
+    в конфиге листа) индексируются сразу при разборе, остальные - при первом
+    запросе. Значения нормализуются и даты разбираются по разу на различное
+    значение, а не на строку. Индекс живёт, пока жив снимок с тем же sha256.
+    """
+    
+    def __init__(self, header, columns, row_count):
+        self.header = header
+        self.columns = columns
+        self.row_count = row_count
+        self._lookup = {}  # номер колонки -> KeyLookup
+        self._dates = {}  # номер колонки -> (array дат по возрастанию (toordinal), array номеров строк)
+    
+    @classmethod
+    def build(cls, snapshot, key_columns=()):
+        """Разбирает CSV потоком, не читая снимок в память целиком"""
+        with read_csv(snapshot) as reader:
+            header = next(reader, [])
+            columns = [Column() for _ in header]
+            mappings = [{} for _ in header]  # значение -> код, только на время разбора
+            row_count = 0
+            for row in reader:
+                if not any(row):
+                    continue
+                if len(row) > len(columns):
+                    # Строка шире заголовка - добавляем безымянные колонки
+                    for _ in range(len(row) - len(columns)):
+                        column = Column()
+                        column.codes.extend(array('I', [0]) * row_count)
+                        column.values.append('')
+                        columns.append(column)
+                        mappings.append({'': 0})
+                        header.append('')
+                for i, column in enumerate(columns):
+                    value = row[i] if i < len(row) else ''
+                    mapping = mappings[i]
+                    code = mapping.get(value)
+                    if code is None:
+                        code = mapping[value] = len(column.values)
+                        column.values.append(value)
+                    column.codes.append(code)
+                row_count += 1
+        del mappings
+        for column in columns:
+            column.values = PackedStrings(column.values)
+        
+        index = cls(header, columns, row_count)
+        wanted = {name.strip().casefold() for name in key_columns}
+        for i, title in enumerate(header):
+            if title.strip().casefold() in wanted or (not wanted and is_key_column(title)):
+                index._build_lookup(i)
+        return index
+    
+    def row(self, n):
+        return tuple(column.values[column.codes[n]] for column in self.columns)
+    
+    def rows(self, numbers):
+        return [self.row(n) for n in numbers]
+    
+    def column(self, name):
+        wanted = name.strip().casefold()
+        for i, title in enumerate(self.header):
+            if title.strip().casefold() == wanted:
+                return i
+        return None
+    
+    def date_column(self, preferred=None):
+        """Колонка с датой: из конфига листа или первая, где в названии есть «дата»/«date»"""
+        if preferred:
+            return self.column(preferred)
+        for i, title in enumerate(self.header):
+            title = title.casefold()
+            if 'дата' in title or 'date' in title:
+                return i
+        return None
+    
+    def is_indexed(self, column):
+        return column in self._lookup
+    
+    def _build_lookup(self, column):
+        lookup = self._lookup[column] = KeyLookup(self.columns[column], self.row_count)
+        return lookup
+    
+    def find(self, column, value):
+        lookup = self._lookup.get(column) or self._build_lookup(column)
+        return self.rows(lookup.find(value))
+    
+    def since(self, column, day):
+        dates = self._dates.get(column)
+        if dates is None:
+            parsed = [parse_date(value) for value in self.columns[column].values]  # код -> дата
+            parsed = [date.toordinal() if date is not None else 0 for date in parsed]
+            codes = self.columns[column].codes
+            numbers = sorted((n for n in range(self.row_count) if parsed[codes[n]]), key=lambda n: parsed[codes[n]])
+            dates = self._dates[column] = (array('I', [parsed[codes[n]] for n in numbers]), array('I', numbers))
+        start = bisect.bisect_left(dates[0], day.toordinal())
+        return self.rows(sorted(dates[1][start:]))
+    
+    @property
+    def nbytes(self):
+        """Примерный размер в памяти: колонки, индексы и срезы по датам"""
+        return (sum(column.nbytes for column in self.columns)
+                + sum(lookup.nbytes for lookup in self._lookup.values())
+                + sum(sys.getsizeof(part) for dates in self._dates.values() for part in dates))
+
+class SheetIndexCache:
+    """LRU индексов по sha256 снимка; одновременные запросы ждут одну сборку"""
+    
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # sha256 -> SheetIndex
+        self._inflight = {}  # sha256 -> asyncio.Task
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    def __contains__(self, sha256):
+        return sha256 in self._entries
+    
+    async def get(self, snapshot, key_columns=()):
+        key = snapshot.sha256
+        index = self._entries.get(key)
+        if index is not None:
+            self._entries.move_to_end(key)
+            return index
+        
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._build(snapshot, key_columns))
+            self._inflight[key] = task
+        return await asyncio.shield(task)
+    
+    async def _build(self, snapshot, key_columns):
+        try:
+            with INDEX_BUILD_SECONDS.time():
+                index = await asyncio.to_thread(SheetIndex.build, snapshot, key_columns)
+            self._entries[snapshot.sha256] = index
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            return index
+        finally:
+            self._inflight.pop(snapshot.sha256, None)
+    
+    def discard(self, sha256):
+        self._entries.pop(sha256, None)
+    
+    @property
+    def nbytes(self):
+        return sum(index.nbytes for index in self._entries.values())
+    
+    def shrink(self, fraction):
+        """Выбрасывает давно не нужные индексы, пока не освободит fraction их
+        объёма. Последний использованный остаётся (иначе следующий /find
+        соберёт его заново и память вернётся), кроме fraction >= 1"""
+        target = self.nbytes * (1 - fraction)
+        keep = 0 if fraction >= 1 else 1
+        while len(self._entries) > keep and self.nbytes > target:
+            self._entries.popitem(last=False)
 
-# ========== НАСТРОЙКИ БОТА ==========
-SPREADSHEET_ID = "17VDwwzNG7ZLM-HAmTTApW5NARkDsieH22D7vg5_jTCA"
-SHEETS = {
-    "Список_карт_номиналов": "0",
-    "Список_номеров_СБП": "2146222680"
-}
+sheet_indexes = SheetIndexCache(INDEX_CACHE_SIZE)
 
-# Токен из переменных окружения Render
-TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
+def rows_to_csv(header, rows):
+    """Собирает найденные строки в CSV-снимок (sha256 по содержимому - для file_id)"""
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(header)
+    writer.writerows(rows)
+    data = text.getvalue().encode('utf-8')
+    return Snapshot(hashlib.sha256(data).hexdigest(), len(data), None, None, time.monotonic(), data=data)
 
-# Логирование
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
-logger = logging.getLogger(__name__)
+def format_rows(header, rows):
+    """Найденные строки для ответа сообщением: "Колонка: значение" по строкам"""
+    blocks = []
+    for row in rows:
+        blocks.append('\n'.join(f"{title}: {value}" for title, value in zip(header, row) if value.strip()))
+    return '\n\n'.join(blocks)
+
+async def reply_rows(context, chat_id, sheet, header, rows, title):
+    """Отвечает найденными строками: немного - текстом, много - CSV файлом"""
+    text = format_rows(header, rows)
+    if len(rows) <= FIND_INLINE_ROWS and len(text) < 3500:
+        await outbound.call(chat_id, context.bot.send_message, chat_id=chat_id, text=f"📊 {sheet.name}: {title}\n\n{text}")
+        return
+    
+    snapshot = await asyncio.to_thread(rows_to_csv, header, rows)
+    stem = os.path.splitext(sheet.filename())[0]
+    await send_document_cached(context.bot, chat_id, snapshot, f"{stem} ({len(rows)} строк).csv", f"📊 {sheet.name}: {title}")
+
+# ========== ЖУРНАЛ ВЫГРУЗОК ==========
+class JobLog:
+    """Журнал выгрузок в SQLite: кто, какой лист, в каком режиме, сколько
+    байт, за сколько и без запроса к Google ли (cache_hit).
+    
+    record() только кладёт строку в буфер - обработчик не ждёт диска.
+    Буфер пишется одной транзакцией в отдельном потоке: раз в
+    JOB_LOG_FLUSH_INTERVAL секунд (задача JobQueue) и досрочно, когда
+    набралось batch_size строк. Пока база недоступна, в буфере остаются
+    последние max_pending строк. Записи только добавляются; старше
+    retention_days - удаляются.
+    """
+    
+    COLUMNS = ('ts', 'chat_id', 'user_id', 'spreadsheet_id', 'gid', 'sheet', 'mode',
+               'bytes', 'latency_ms', 'cache_hit', 'status')
+    
+    def __init__(self, path, batch_size, retention_days, max_pending=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.retention_days = retention_days
+        self.max_pending = max_pending
+        self._pending = deque(maxlen=max_pending)
+        self._flushing = None
+        self._pruned_at = 0.0
+        self._local = threading.local()
+        self.written = 0
+    
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "ts REAL, chat_id INTEGER, user_id INTEGER, spreadsheet_id TEXT, gid TEXT, "
+                "sheet TEXT, mode TEXT, bytes INTEGER, latency_ms REAL, cache_hit INTEGER, status TEXT)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_ts ON jobs (ts)")
+            self._local.connection = connection
+        return connection
+    
+    def record(self, **row):
+        """Добавляет запись в буфер (без ожидания и без ввода-вывода)"""
+        if not self.path:
+            return
+        row['ts'] = time.time()
+        self._pending.append(tuple(row.get(column) for column in self.COLUMNS))
+        if len(self._pending) >= self.batch_size and (self._flushing is None or self._flushing.done()):
+            self._flushing = asyncio.ensure_future(self.flush())
+    
+    async def flush(self):
+        """Пишет накопленные записи на диск"""
+        if not self._pending:
+            return 0
+        rows = list(self._pending)
+        self._pending.clear()
+        try:
+            await asyncio.to_thread(self._write, rows)
+        except Exception as e:
+            logger.warning(f"Не удалось записать журнал выгрузок ({len(rows)} записей): {e}")
+            # Вернём в буфер, не теряя новых записей; лишние - самые старые
+            self._pending = deque(rows + list(self._pending), maxlen=self.max_pending)
+            return 0
+        self.written += len(rows)
+        return len(rows)
+    
+    def _write(self, rows):
+        connection = self._connection()
+        placeholders = ', '.join('?' * len(self.COLUMNS))
+        with connection:
+            connection.execute("BEGIN")
+            connection.executemany(f"INSERT INTO jobs ({', '.join(self.COLUMNS)}) VALUES ({placeholders})", rows)
+            if time.time() - self._pruned_at > 3600:
+                connection.execute("DELETE FROM jobs WHERE ts < ?", (time.time() - self.retention_days * 86400,))
+                self._pruned_at = time.time()
+    
+    def summary(self, since, top=5):
+        """Сводка за период с since (unix time): итоги, часы пик, самые тяжёлые листы"""
+        connection = self._connection()
+        totals = connection.execute(
+            "SELECT COUNT(*), COUNT(DISTINCT chat_id), COALESCE(SUM(bytes), 0), AVG(cache_hit), "
+            "AVG(latency_ms), MAX(latency_ms), SUM(status = 'error') FROM jobs WHERE ts >= ?",
+            (since,),
+        ).fetchone()
+        hours = connection.execute(
+            "SELECT CAST(strftime('%H', ts, 'unixepoch') AS INTEGER) AS hour, COUNT(*), COALESCE(SUM(bytes), 0) "
+            "FROM jobs WHERE ts >= ? GROUP BY hour ORDER BY COUNT(*) DESC LIMIT ?",
+            (since, top),
+        ).fetchall()
+        sheets = connection.execute(
+            "SELECT sheet, COUNT(*), COALESCE(SUM(bytes), 0), AVG(cache_hit), AVG(latency_ms) "
+            "FROM jobs WHERE ts >= ? GROUP BY spreadsheet_id, gid ORDER BY SUM(bytes) DESC LIMIT ?",
+            (since, top),
+        ).fetchall()
+        modes = connection.execute(
+            "SELECT mode, COUNT(*) FROM jobs WHERE ts >= ? GROUP BY mode ORDER BY COUNT(*) DESC",
+            (since,),
+        ).fetchall()
+        return {'totals': totals, 'hours': hours, 'sheets': sheets, 'modes': modes}
+
+job_log = JobLog(JOB_LOG_DB, JOB_LOG_BATCH, JOB_LOG_RETENTION_DAYS)
+FunctionMetric('job_log_pending', 'Job log records waiting to be written', 'gauge', lambda: len(job_log._pending))
+FunctionMetric('job_log_written_total', 'Job log records written', 'counter', lambda: job_log.written)
 
-# ========== МОНИТОРИНГ РЕСУРСОВ ==========
-def check_resources():
-    """Проверка использования памяти"""
+async def flush_job_log(context: ContextTypes.DEFAULT_TYPE):
+    """Сбрасывает журнал выгрузок на диск (задача JobQueue)"""
+    await job_log.flush()
+
+# ========== УПРАВЛЕНИЕ ПАМЯТЬЮ ==========
+def read_rss_mb():
+    """Текущее потребление памяти процессом (None, если psutil недоступен)"""
     try:
         import psutil
-        process = psutil.Process()
-        memory_mb = process.memory_info().rss / 1024 / 1024
+        return psutil.Process().memory_info().rss / 1024 / 1024
+    except Exception:
+        return None
+
+class MemoryGovernor:
+    """Следит за памятью и реагирует ступенчато, а не убивает процесс сразу.
+    
+    - выше MEMORY_SOFT_MB: сбрасываем кэши (зарегистрированные shedders) и gc;
+    - выше MEMORY_HARD_MB: кроме того, не принимаем новые выгрузки;
+    - выше MEMORY_CRITICAL_MB несколько замеров подряд: перезапуск, но только
+      после того, как активные выгрузки закончатся (drain-and-restart).
+    """
+    
+    def __init__(self, soft_mb, hard_mb, critical_mb, critical_samples=3):
+        self.soft_mb = soft_mb
+        self.hard_mb = hard_mb
+        self.critical_mb = critical_mb
+        self.critical_samples = critical_samples
+        self.rss_mb = None
+        self.overloaded = False
+        self.draining = False
+        self._critical_count = 0
+        self._shedders = []
+        self.shed_count = 0
+    
+    def register_shedder(self, shed):
+        """shed(fraction) освобождает долю fraction своего кэша"""
+        self._shedders.append(shed)
+    
+    def shed(self, fraction):
+        for shed in self._shedders:
+            try:
+                shed(fraction)
+            except Exception as e:
+                logger.warning(f"Не удалось освободить кэш: {e}")
+        gc.collect()
+        self.shed_count += 1
+    
+    def admit(self):
+        """Можно ли начать новую выгрузку. Возвращает текст отказа или None"""
+        if self.draining:
+            return "🔄 Бот перезапускается, попробуйте через минуту"
+        if self.overloaded:
+            return "⏳ Бот перегружен, попробуйте через минуту"
+        return None
+    
+    async def check(self):
+        rss_mb = await asyncio.to_thread(read_rss_mb)
+        if rss_mb is None:
+            return  # Если не удалось проверить, продолжаем работу
+        self.rss_mb = rss_mb
         
-        if memory_mb > 400:  # Близко к лимиту 512MB
-            logger.warning(f"⚠️ Высокое использование памяти: {memory_mb:.1f}MB")
-            return False
-        return True
-    except:
-        return True  # Если не удалось проверить, продолжаем работу
+        if rss_mb > self.soft_mb:
+            # Чем ближе к жёсткому порогу, тем больше выбрасываем
+            fraction = min(1.0, (rss_mb - self.soft_mb) / max(self.hard_mb - self.soft_mb, 1))
+            self.shed(max(fraction, 0.25))
+            rss_mb = self.rss_mb = await asyncio.to_thread(read_rss_mb) or rss_mb
+        
+        overloaded = rss_mb > self.hard_mb
+        if overloaded != self.overloaded:
+            self.overloaded = overloaded
+            if overloaded:
+                logger.warning(f"⚠️ Высокое использование памяти: {rss_mb:.1f}MB, новые выгрузки приостановлены")
+            else:
+                logger.info(f"✅ Память в норме ({rss_mb:.1f}MB), выгрузки снова принимаются")
+        
+        self._critical_count = self._critical_count + 1 if rss_mb > self.critical_mb else 0
+        if self._critical_count >= self.critical_samples:
+            await drain_and_restart(f"память {rss_mb:.1f}MB выше {self.critical_mb}MB", exit_code=1)
 
-def resource_monitor():
-    """Фоновая проверка ресурсов каждые 30 минут"""
-    while True:
-        time.sleep(1800)  # 30 минут
-        if not check_resources():
-            logger.error("🔄 Превышение лимита памяти, перезапуск...")
-            os._exit(1)  # Принудительный перезапуск
-
-# ========== АВТОПЕРЕЗАПУСК ЧЕРЕЗ 48 ЧАСОВ ==========
-def auto_restart_timer():
-    """Принудительный перезапуск каждые 48 часов"""
-    time.sleep(172800)  # 48 часов = 2 дня
-    logger.info("⏰ Время планового перезапуска (48 часов)")
+memory_governor = MemoryGovernor(MEMORY_SOFT_MB, MEMORY_HARD_MB, MEMORY_CRITICAL_MB)
+memory_governor.register_shedder(lambda fraction: export_cache.shrink(fraction))
+memory_governor.register_shedder(lambda fraction: sheet_indexes.shrink(fraction))
+
+async def drain_and_restart(reason, exit_code=0):
+    """Перестаёт принимать выгрузки, ждёт завершения активных и перезапускает процесс"""
+    if memory_governor.draining:
+        return
+    memory_governor.draining = True
+    logger.warning(f"🔄 Перезапуск ({reason}): ждём завершения {len(outbound.active_jobs)} выгрузок...")
+    
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while outbound.active_jobs and time.monotonic() < deadline:
+        await asyncio.sleep(1)
+    if outbound.active_jobs:
+        logger.error(f"Не дождались {len(outbound.active_jobs)} выгрузок за {DRAIN_TIMEOUT} с")
+    await job_log.flush()
+    
     print("=" * 60)
-    print("🔄 Плановый перезапуск для предотвращения падений")
+    print(f"🔄 Перезапуск: {reason}")
     print("=" * 60)
-    os._exit(0)
+    os._exit(exit_code)  # Render поднимет процесс заново
+
+async def memory_monitor(context: ContextTypes.DEFAULT_TYPE):
+    """Фоновая проверка памяти каждые MEMORY_SAMPLE_INTERVAL секунд (задача JobQueue)"""
+    await memory_governor.check()
+
+# ========== ПЛАНОВЫЙ ПЕРЕЗАПУСК (ПО ЖЕЛАНИЮ) ==========
+async def auto_restart_timer(context: ContextTypes.DEFAULT_TYPE):
+    """Плановый перезапуск через MAX_UPTIME_HOURS часов (задача JobQueue)"""
+    logger.info(f"⏰ Время планового перезапуска ({MAX_UPTIME_HOURS} часов)")
+    await drain_and_restart("плановый перезапуск")
+
+# ========== ФОНОВОЕ ОБНОВЛЕНИЕ ЛИСТОВ ==========
+def with_jitter(delay):
+    """Разбрасывает задержку на ±PREFETCH_JITTER, чтобы листы не обновлялись одновременно"""
+    return delay * random.uniform(1 - PREFETCH_JITTER, 1 + PREFETCH_JITTER)
+
+async def prefetch_job(context: ContextTypes.DEFAULT_TYPE):
+    """Обновляет один лист в кэше и планирует следующий запуск.
+    
+    При ошибках интервал растёт экспоненциально (до PREFETCH_MAX_BACKOFF),
+    чтобы не долбить Google во время сбоя.
+    """
+    job = context.job
+    state = job.data
+    sheet = {sheet.key: sheet for sheet in sheet_registry.all_sheets()}.get((state['spreadsheet_id'], state['gid']))
+    if sheet is None:
+        logger.info(f"Лист убран из реестра, фоновое обновление {job.name} остановлено")
+        return
+    try:
+        previous = export_cache.peek(state['spreadsheet_id'], state['gid'])
+        snapshot = await export_cache.refresh(state['spreadsheet_id'], state['gid'])
+        if previous is not None and previous.sha256 != snapshot.sha256 and previous.sha256 in sheet_indexes:
+            # По листу уже искали - пересобираем индекс сейчас, а не на первом запросе
+            sheet_indexes.discard(previous.sha256)
+            await sheet_indexes.get(snapshot, sheet.key_columns)
+        state['failures'] = 0
+        delay = PREFETCH_INTERVAL
+    except Exception as e:
+        state['failures'] += 1
+        delay = min(PREFETCH_INTERVAL * 2 ** state['failures'], PREFETCH_MAX_BACKOFF)
+        logger.warning(f"Фоновое обновление {job.name} не удалось ({state['failures']} подряд): {e}")
+    else:
+        # Сравниваем с последней разосланной версией, а не с предыдущей в кэше:
+        # лист мог обновиться и по запросу пользователя, и пока бот был выключен
+        delivered = subscription_store.delivered(sheet)
+        if delivered != snapshot.sha256:
+            if delivered is not None:
+                await notify_subscribers(context.bot, sheet, snapshot)
+            await subscription_store.mark_delivered(sheet, snapshot.sha256)
+    
+    context.job_queue.run_once(prefetch_job, with_jitter(delay), data=state, name=job.name)
+
+def schedule_background_jobs(application):
+    """Ставит в JobQueue мониторинг памяти, автоперезапуск и обновление листов"""
+    job_queue = application.job_queue
+    if job_queue is None:
+        logger.error("❌ JobQueue недоступна: установите python-telegram-bot[job-queue]")
+        return
+    
+    job_queue.run_repeating(memory_monitor, interval=MEMORY_SAMPLE_INTERVAL, first=MEMORY_SAMPLE_INTERVAL)
+    if JOB_LOG_DB:
+        job_queue.run_repeating(flush_job_log, interval=JOB_LOG_FLUSH_INTERVAL, first=JOB_LOG_FLUSH_INTERVAL)
+    if MAX_UPTIME_HOURS > 0:
+        job_queue.run_once(auto_restart_timer, MAX_UPTIME_HOURS * 3600)
+    
+    # При нескольких процессах листы обновляет только ведущий - остальные
+    # видят его выгрузки через общее хранилище
+    if PREFETCH_INTERVAL > 0 and WORKER_INDEX == 0:
+        job_queue.run_repeating(sync_prefetch_jobs, interval=CONFIG_RELOAD_INTERVAL, first=1)
+
+async def sync_prefetch_jobs(context: ContextTypes.DEFAULT_TYPE):
+    """Заводит фоновое обновление для листов, появившихся в реестре"""
+    for sheet in sheet_registry.all_sheets():
+        name = f"prefetch:{sheet.spreadsheet_id}:{sheet.gid}"
+        if context.job_queue.get_jobs_by_name(name):
+            continue
+        state = {'spreadsheet_id': sheet.spreadsheet_id, 'gid': sheet.gid, 'failures': 0}
+        # Первый прогрев сразу, с небольшим разбросом
+        context.job_queue.run_once(prefetch_job, random.uniform(0, 5), data=state, name=name)
+
+# ========== ВЕБ-СЕРВЕР: HEALTH CHECK И WEBHOOK ==========
+# Один asyncio-сервер на PORT в том же event loop, что и бот: отвечает
+# UptimeRobot/Render на /health и принимает обновления Telegram в режиме webhook
+async def health(request):
+    """Для UptimeRobot и ручной проверки в браузере (HEAD обрабатывается автоматически)"""
+    if not request.app['application'].done():
+        return web.Response(text='OK Bot (starting)')
+    return web.Response(text='OK Bot')
+
+async def telegram_webhook(request):
+    """Принимает обновление от Telegram и ставит его в очередь приложения"""
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    # Обновления, пришедшие во время запуска, ждут готовности приложения
+    application = await request.app['application']
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except Exception as e:
+        logger.warning(f"Некорректное обновление от webhook: {e}")
+        return web.Response(status=400)
+    await application.update_queue.put(update)
+    return web.Response()
+
+async def metrics(request):
+    """Метрики для Prometheus"""
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+async def metrics_json(request):
+    """Метрики обработчика для главного процесса (см. ingress_metrics)"""
+    return web.json_response(collect_metrics())
+
+async def debug_stalls(request):
+    """Последние зависания event loop со стеками"""
+    return web.json_response(list(loop_watchdog.stalls), dumps=lambda data: json.dumps(data, ensure_ascii=False, indent=2))
+
+def build_web_app():
+    web_app = web.Application()
+    # Приложение бота появится позже веб-сервера (см. run_bot)
+    web_app['application'] = asyncio.get_running_loop().create_future()
+    web_app.router.add_get('/', health)
+    web_app.router.add_get('/health', health)
+    web_app.router.add_get('/metrics', metrics)
+    web_app.router.add_get('/debug/stalls', debug_stalls)
+    if BOT_MODE == 'webhook':
+        web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
+
+async def warm_load_caches():
+    """Поднимает прошлые выгрузки с диска (в фоне, не задерживая запуск)"""
+    try:
+        restored = await export_cache.restore()
+        if restored:
+            logger.info(f"💾 Из {SNAPSHOT_DIR} восстановлено листов: {restored}")
+    except Exception as e:
+        logger.warning(f"Не удалось восстановить выгрузки из {SNAPSHOT_DIR}: {e}")
+
+async def run_bot():
+    """Запускает веб-сервер, затем бота в том же event loop и ждёт сигнала остановки.
+    
+    Порт открывается первым: health отвечает, пока в отдельном потоке
+    импортируется telegram, а кэш выгрузок поднимается с диска в фоне.
+    """
+    web_app = build_web_app()
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    print(f"✅ Health server started on port {PORT}")
+    
+    stop_signal = asyncio.get_running_loop().create_future()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(
+            signum, lambda signum=signum: stop_signal.done() or stop_signal.set_result(signum)
+        )
+    
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    warm_up = asyncio.create_task(warm_load_caches())
+    try:
+        await asyncio.to_thread(load_dependencies)
+        # Создаем приложение с обработчиками и фоновыми задачами (в режиме
+        # webhook обновления приходят на наш сервер, Updater не нужен)
+        application = build_application(with_updater=BOT_MODE != 'webhook')
+        async with application:
+            await application.start()
+            web_app['application'].set_result(application)
+            logger.info(f"🤖 Бот запущен и ожидает сообщений (через {time.monotonic() - STARTED_AT:.2f} с после старта)")
+            if BOT_MODE == 'webhook':
+                await application.bot.set_webhook(
+                    url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+                logger.info(f"🌐 Webhook: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+            else:
+                await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            
+            signum = await stop_signal
+            logger.info(f"🚦 Получен сигнал {signum}, завершаем работу...")
+            
+            if application.updater is not None and application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+    finally:
+        lag_monitor.cancel()
+        warm_up.cancel()
+        await job_log.flush()
+        await close_http_client()
+        await runner.cleanup()
+    return signum
+
+# ========== НЕСКОЛЬКО ПРОЦЕССОВ-ОБРАБОТЧИКОВ ==========
+# Главный процесс только принимает обновления (webhook или polling) и
+# раскладывает их по очередям обработчиков: chat_id % WORKERS. Все
+# обновления одного чата попадают в один процесс, поэтому защита от
+# повторных нажатий (outbound.begin_job, она в памяти процесса) работает
+# как раньше. Порядок обработки внутри чата, как и при одном процессе, не
+# гарантирован: обновления обрабатываются параллельно (concurrent_updates),
+# иначе повторное нажатие ждало бы конца выгрузки вместо ответа "уже идёт".
+# Упавший или перезапустившийся по памяти обработчик поднимается заново.
+# Метрики и /debug/stalls каждый обработчик отдаёт на своём локальном
+# порту, а /metrics главного процесса собирает их с меткой worker.
+def update_chat_id(data):
+    """chat_id обновления (или id пользователя), по нему выбирается обработчик"""
+    for field in ('message', 'edited_message', 'channel_post', 'edited_channel_post', 'my_chat_member', 'chat_member', 'chat_join_request'):
+        if field in data:
+            return data[field].get('chat', {}).get('id', 0)
+    if 'callback_query' in data:
+        query = data['callback_query']
+        return query.get('message', {}).get('chat', {}).get('id') or query.get('from', {}).get('id', 0)
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from'].get('id', 0)
+    return data.get('update_id', 0)
+
+def build_application(with_updater):
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .concurrent_updates(True)  # Параллельно, в т.ч. обновления одного чата (см. begin_job)
+    )
+    if not with_updater:
+        builder = builder.updater(None)
+    application = builder.build()
+    register_handlers(application)
+    schedule_background_jobs(application)
+    return application
+
+def run_worker(updates):
+    """Точка входа процесса-обработчика: берёт обновления из своей очереди"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Останавливает главный процесс
+    asyncio.run(serve_worker(build_application(with_updater=False), updates))
+
+async def start_worker_web_app():
+    """Метрики обработчика на локальном порту - их забирает главный процесс"""
+    web_app = web.Application()
+    web_app.router.add_get('/metrics', metrics)
+    web_app.router.add_get('/metrics.json', metrics_json)
+    web_app.router.add_get('/debug/stalls', debug_stalls)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, '127.0.0.1', WORKER_METRICS_PORT + WORKER_INDEX).start()
+    except OSError as e:
+        logger.warning(f"Обработчик {WORKER_INDEX}: порт метрик {WORKER_METRICS_PORT + WORKER_INDEX} недоступен: {e}")
+    return runner
+
+async def serve_worker(application, updates):
+    lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+    warm_up = asyncio.create_task(warm_load_caches())
+    runner = await start_worker_web_app()
+    try:
+        async with application:
+            await application.start()
+            logger.info(f"👷 Обработчик {WORKER_INDEX} запущен (pid {os.getpid()})")
+            while True:
+                raw = await asyncio.to_thread(updates.get)
+                if raw is None:
+                    break
+                await application.update_queue.put(Update.de_json(json.loads(raw), application.bot))
+            # Даём дойти начатым выгрузкам, как при обычной остановке
+            deadline = time.monotonic() + DRAIN_TIMEOUT
+            while outbound.active_jobs and time.monotonic() < deadline:
+                await asyncio.sleep(0.5)
+            await application.stop()
+    finally:
+        lag_monitor.cancel()
+        warm_up.cancel()
+        await job_log.flush()
+        await close_http_client()
+        await runner.cleanup()
+
+class WorkerPool:
+    """Процессы-обработчики и их очереди.
+    
+    Перезапущенный обработчик получает новую очередь: простаивающий
+    обработчик всегда ждёт в updates.get() и держит общий замок чтения
+    очереди, а после os._exit или падения этот замок уже никто не
+    отпустит. Обновления, которые старый обработчик не успел забрать,
+    теряются вместе с ним (как и те, что он уже начал обрабатывать).
+    """
+    
+    def __init__(self, size):
+        self._context = multiprocessing.get_context('spawn')
+        self.queues = [self._context.Queue() for _ in range(size)]
+        self.processes = [None] * size
+        self.restarts = 0
+    
+    def start(self, index):
+        # Номер обработчика передаём через окружение: модуль читает настройки при импорте
+        os.environ['WORKER_INDEX'] = str(index)
+        try:
+            process = self._context.Process(target=run_worker, args=(self.queues[index],), name=f"worker-{index}")
+            process.start()
+        finally:
+            os.environ.pop('WORKER_INDEX', None)
+        self.processes[index] = process
+    
+    def start_all(self):
+        for index in range(len(self.queues)):
+            self.start(index)
+    
+    def revive(self):
+        """Поднимает обработчики, которые завершились (в т.ч. drain_and_restart)"""
+        for index, process in enumerate(self.processes):
+            if not process.is_alive():
+                logger.warning(f"Обработчик {index} завершился (код {process.exitcode}), запускаем заново")
+                process.join()
+                self.restarts += 1
+                # Старая очередь больше не читается: не ждём, пока она допишется
+                self.queues[index].close()
+                self.queues[index].cancel_join_thread()
+                self.queues[index] = self._context.Queue()
+                self.start(index)
+    
+    @property
+    def alive(self):
+        return sum(process is not None and process.is_alive() for process in self.processes)
+    
+    def dispatch(self, data):
+        self.queues[update_chat_id(data) % len(self.queues)].put(json.dumps(data, ensure_ascii=False))
+    
+    def stop(self, timeout):
+        for updates in self.queues:
+            updates.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+
+async def ingress_webhook(request):
+    """Webhook главного процесса: проверяет секрет и отдаёт обновление обработчику"""
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    try:
+        data = await request.json()
+    except Exception as e:
+        logger.warning(f"Некорректное обновление от webhook: {e}")
+        return web.Response(status=400)
+    request.app['pool'].dispatch(data)
+    return web.Response()
+
+async def fetch_from_workers(request, path):
+    """Ответы обработчиков на path (None - обработчик не ответил)"""
+    session = request.app['http']
+    
+    async def fetch(index):
+        try:
+            async with session.get(f"http://127.0.0.1:{WORKER_METRICS_PORT + index}{path}") as response:
+                response.raise_for_status()
+                return await response.json()
+        except Exception as e:
+            logger.debug(f"Обработчик {index} не отдал {path}: {e}")
+            return None
+    return await asyncio.gather(*(fetch(index) for index in range(len(request.app['pool'].processes))))
+
+async def ingress_metrics(request):
+    """/metrics главного процесса: ряды всех обработчиков с меткой worker,
+    worker_metrics_up по каждому и собственные метрики главного процесса"""
+    replies = await fetch_from_workers(request, '/metrics.json')
+    families = {}  # имя -> (описание, тип, ряды)
+    for index, reply in enumerate(replies):
+        for name, help_text, kind, samples in reply or ():
+            family = families.setdefault(name, (help_text, kind, []))
+            family[2].extend((sample, [('worker', index), *labels], value) for sample, labels, value in samples)
+    families['worker_metrics_up'] = ('1 if the worker answered the metrics scrape', 'gauge',
+                                     [('worker_metrics_up', [('worker', index)], int(reply is not None)) for index, reply in enumerate(replies)])
+    # Из своих - только метрики надзора: остальные в главном процессе нулевые,
+    # он сам ничего не выгружает
+    for metric in request.app['own_metrics']:
+        families[metric.name] = (metric.help_text, metric.kind, list(metric.samples()))
+    return web.Response(text=render_metrics([(name, *family) for name, family in families.items()]),
+                        content_type='text/plain', charset='utf-8')
+
+async def ingress_stalls(request):
+    """Зависания event loop всех обработчиков, с номером обработчика"""
+    replies = await fetch_from_workers(request, '/debug/stalls')
+    stalls = sorted(({'worker': index, **stall} for index, reply in enumerate(replies) for stall in reply or ()),
+                    key=lambda stall: stall['started'])
+    return web.json_response(stalls, dumps=lambda data: json.dumps(data, ensure_ascii=False, indent=2))
+
+async def ingress_health(request):
+    pool = request.app['pool']
+    if not pool.alive:
+        return web.Response(status=503, text='No workers')
+    return web.Response(text=f'OK Bot ({pool.alive}/{len(pool.processes)} workers)')
+
+async def poll_updates(bot, pool):
+    """Polling в главном процессе: getUpdates и раздача обработчикам"""
+    await bot.delete_webhook()
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=Update.ALL_TYPES)
+        except TelegramError as e:
+            logger.warning(f"getUpdates не удался: {e}")
+            await asyncio.sleep(5)
+            continue
+        for update in updates:
+            pool.dispatch(update.to_dict())
+            offset = update.update_id + 1
+
+async def run_workers():
+    """Главный процесс при WORKERS > 1: веб-сервер, приём обновлений, надзор за обработчиками"""
+    pool = WorkerPool(WORKERS)
+    pool.start_all()
+    
+    web_app = web.Application()
+    web_app['pool'] = pool
+    web_app['own_metrics'] = [
+        FunctionMetric('workers_alive', 'Worker processes running', 'gauge', lambda: pool.alive),
+        FunctionMetric('worker_restarts_total', 'Worker processes restarted', 'counter', lambda: pool.restarts),
+    ]
+    web_app['http'] = ClientSession(timeout=ClientTimeout(total=5))
+    web_app.router.add_get('/', ingress_health)
+    web_app.router.add_get('/health', ingress_health)
+    web_app.router.add_get('/metrics', ingress_metrics)
+    web_app.router.add_get('/debug/stalls', ingress_stalls)
+    if BOT_MODE == 'webhook':
+        web_app.router.add_post(WEBHOOK_PATH, ingress_webhook)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    print(f"✅ Health server started on port {PORT}, workers: {WORKERS}")
+    
+    stop_signal = asyncio.get_running_loop().create_future()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(
+            signum, lambda signum=signum: stop_signal.done() or stop_signal.set_result(signum)
+        )
+    
+    await asyncio.to_thread(load_dependencies)
+    from telegram import Bot
+    
+    bot = Bot(TOKEN, base_url=TELEGRAM_API_URL)
+    background = []
+    try:
+        async with bot:
+            if BOT_MODE == 'webhook':
+                await bot.set_webhook(
+                    url=f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=Update.ALL_TYPES,
+                )
+                logger.info(f"🌐 Webhook: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+            else:
+                background.append(asyncio.create_task(poll_updates(bot, pool)))
+            
+            while not stop_signal.done():
+                await asyncio.wait([stop_signal], timeout=1)
+                if not stop_signal.done():
+                    pool.revive()
+            signum = stop_signal.result()
+            logger.info(f"🚦 Получен сигнал {signum}, останавливаем обработчики...")
+            for task in background:
+                task.cancel()
+    finally:
+        await asyncio.to_thread(pool.stop, DRAIN_TIMEOUT + 5)
+        await web_app['http'].close()
+        await runner.cleanup()
+    return signum
 
 # ========== ФУНКЦИИ БОТА ==========
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -100,66 +2833,356 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     logger.info(f"Пользователь {user.id} запустил бота")
 
+# Режимы /download: по CSV на лист, только изменённые, один zip-архив, gzip на лист
+# и другие форматы (xlsx и parquet - если установлены openpyxl/pyarrow)
+DOWNLOAD_MODES = ('csv', 'changed', 'zip', 'gzip', 'xlsx', 'parquet', 'jsonl')
+
 async def download_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Команда /download - показывает кнопку"""
-    keyboard = [[InlineKeyboardButton("📥 Скачать CSV файлы", callback_data='download_csv')]]
+    """Команда /download - показывает кнопки, /download <режим> - сразу шлёт файлы,
+    /download <лист> [since <дата>] - один лист или только строки начиная с даты"""
+    user = update.effective_user
+    mode = context.args[0].lower() if context.args else None
+    if mode is not None:
+        chat_id = update.effective_chat.id
+        refusal = memory_governor.admit()
+        if refusal:
+            await update.message.reply_text(refusal)
+            return
+        if not outbound.begin_job(chat_id):
+            await update.message.reply_text("⏳ Предыдущая выгрузка ещё идёт, подождите...")
+            return
+        try:
+            logger.info(f"Пользователь {user.id} запросил файлы ({' '.join(context.args)})")
+            if mode in DOWNLOAD_MODES and not format_available(mode):
+                await update.message.reply_text(f"❌ Формат {mode} не поддерживается на этом сервере")
+            elif mode in DOWNLOAD_MODES:
+                await run_download(context, chat_id, user, mode)
+            else:
+                await download_sheet_slice(update, context, chat_id)
+        finally:
+            outbound.end_job(chat_id)
+        return
+    
+    keyboard = [
+        [InlineKeyboardButton("📥 Скачать CSV файлы", callback_data='download_csv')],
+        [InlineKeyboardButton("🔄 Только изменённые", callback_data='download_changed')],
+        [
+            InlineKeyboardButton("📦 Одним ZIP", callback_data='download_zip'),
+            InlineKeyboardButton("🗜 CSV в gzip", callback_data='download_gzip'),
+        ],
+        [
+            InlineKeyboardButton(title, callback_data=f'download_{mode}')
+            for mode, title in (('xlsx', "📗 XLSX"), ('parquet', "🧱 Parquet"), ('jsonl', "🧾 JSONL"))
+            if format_available(mode)
+        ],
+    ]
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     await update.message.reply_text("Нажмите кнопку для скачивания файлов:", reply_markup=reply_markup)
-    logger.info(f"Пользователь {update.effective_user.id} запросил файлы")
+    logger.info(f"Пользователь {user.id} запросил файлы")
+
+async def download_sheet_slice(update, context, chat_id):
+    """/download <лист> [since <дата>]"""
+    match = re.fullmatch(r"(.+?)(?:\s+since\s+(\S+))?", ' '.join(context.args), re.IGNORECASE)
+    sheet = sheet_registry.find_sheet(chat_id, match.group(1))
+    if sheet is None:
+        names = ', '.join(sheet.name for sheet in sheet_registry.sheets_for_chat(chat_id)) or "нет"
+        await update.message.reply_text(
+            f"❓ Неизвестный режим или лист: {match.group(1)}\n"
+            f"Режимы: {', '.join(DOWNLOAD_MODES)}\nЛисты: {names}"
+        )
+        return
+    
+    user_id = update.effective_user.id if update.effective_user else None
+    if match.group(2) is None:
+        await send_sheet(context, chat_id, sheet, user_id=user_id)
+        return
+    day = parse_date(match.group(2))
+    if day is None:
+        await update.message.reply_text("❓ Не понял дату, пример: /download Список_номеров_СБП since 01.06.2024")
+        return
+    
+    started = time.monotonic()
+    snapshot = None
+    with DOWNLOAD_SECONDS.time(mode='since'):
+        try:
+            snapshot = await export_cache.get(sheet.spreadsheet_id, sheet.gid)
+            index = await sheet_indexes.get(snapshot, sheet.key_columns)
+            column = index.date_column(sheet.date_column)
+            if column is None:
+                await update.message.reply_text(f"❓ В листе {sheet.name} нет колонки с датой")
+                return
+            rows = await asyncio.to_thread(index.since, column, day)
+            if not rows:
+                await update.message.reply_text(f"🔍 В листе {sheet.name} нет строк с {day:%d.%m.%Y}")
+                return
+            await reply_rows(context, chat_id, sheet, index.header, rows, f"с {day:%d.%m.%Y}{stale_note(snapshot)}")
+            record_job(chat_id, user_id, sheet, 'since', started, snapshot, 'sent')
+        except Exception as e:
+            record_job(chat_id, user_id, sheet, 'since', started, snapshot, 'error')
+            await report_sheet_error(context, chat_id, sheet.name, e)
+
+async def find_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /find <колонка>=<значение> - ищет строки во всех листах чата"""
+    chat_id = update.effective_chat.id
+    column_name, sep, value = ' '.join(context.args).partition('=')
+    if not sep or not column_name.strip() or not value.strip():
+        await update.message.reply_text("❓ Формат: /find <колонка>=<значение>, например /find Номер карты=2200 1234 5678 9012")
+        return
+    refusal = memory_governor.admit()
+    if refusal:
+        await update.message.reply_text(refusal)
+        return
+    
+    async def search(sheet):
+        try:
+            snapshot = await export_cache.get(sheet.spreadsheet_id, sheet.gid)
+            index = await sheet_indexes.get(snapshot, sheet.key_columns)
+        except Exception as e:
+            await report_sheet_error(context, chat_id, sheet.name, e)
+            return sheet, None, None, ""
+        column = index.column(column_name)
+        if column is None:
+            return sheet, index, None, ""
+        if index.is_indexed(column):
+            return sheet, index, index.find(column, value), stale_note(snapshot)
+        return sheet, index, await asyncio.to_thread(index.find, column, value), stale_note(snapshot)
+    
+    logger.info(f"Пользователь {update.effective_user.id} ищет {column_name.strip()}={value.strip()}")
+    results = await asyncio.gather(*(search(sheet) for sheet in sheet_registry.sheets_for_chat(chat_id)))
+    searched = [(sheet, index, rows, stale) for sheet, index, rows, stale in results if rows is not None]
+    if not searched:
+        columns = sorted({title for sheet, index, rows, stale in results if index is not None for title in index.header if title})
+        await update.message.reply_text(f"❓ Нет такой колонки: {column_name.strip()}\nКолонки: {', '.join(columns) or 'нет'}")
+        return
+    
+    found = [(sheet, index, rows, stale) for sheet, index, rows, stale in searched if rows]
+    if not found:
+        await update.message.reply_text("🔍 Ничего не найдено")
+        return
+    for sheet, index, rows, stale in found:
+        try:
+            await reply_rows(context, chat_id, sheet, index.header, rows, f"{column_name.strip()} = {value.strip()}{stale}")
+        except Exception as e:
+            await report_sheet_error(context, chat_id, sheet.name, e)
+
+def resolve_sheets(update, context):
+    """Листы из аргументов команды: без аргументов - все листы чата,
+    иначе один лист по имени (None, если такого нет)"""
+    chat_id = update.effective_chat.id
+    if not context.args:
+        return sheet_registry.sheets_for_chat(chat_id)
+    sheet = sheet_registry.find_sheet(chat_id, ' '.join(context.args))
+    return [sheet] if sheet is not None else None
+
+async def subscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /subscribe [лист] - присылать лист при каждом его изменении"""
+    chat_id = update.effective_chat.id
+    sheets = resolve_sheets(update, context)
+    if not sheets:
+        names = ', '.join(sheet.name for sheet in sheet_registry.sheets_for_chat(chat_id)) or "нет"
+        await update.message.reply_text(f"❓ Нет такого листа. Листы: {names}")
+        return
+    
+    added = await subscription_store.subscribe(sheets, chat_id)
+    if added:
+        await update.message.reply_text(
+            f"🔔 Подписка оформлена: {', '.join(sheet.name for sheet in added)}\n"
+            f"Пришлю файл, как только лист изменится. Отписаться - /unsubscribe"
+        )
+    else:
+        await update.message.reply_text("🔔 Вы уже подписаны")
+    logger.info(f"Чат {chat_id} подписался на {len(added)} листов")
+
+async def unsubscribe_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /unsubscribe [лист] - отписаться от листа или от всех"""
+    chat_id = update.effective_chat.id
+    sheets = resolve_sheets(update, context) if context.args else None
+    if context.args and not sheets:
+        await update.message.reply_text("❓ Нет такого листа")
+        return
+    
+    removed = await subscription_store.unsubscribe(sheets, chat_id)
+    await update.message.reply_text("🔕 Подписка отменена" if removed else "🔕 Подписок не было")
+    logger.info(f"Чат {chat_id} отписался от {removed} листов")
+
+def stale_note(snapshot):
+    """Пометка для подписи, если пришлось отдать устаревшую версию листа"""
+    if not export_cache.is_stale(snapshot):
+        return ""
+    minutes = int((time.monotonic() - snapshot.fetched_at) // 60)
+    if minutes < 120:
+        age = f"{minutes} мин."
+    elif minutes < 48 * 60:
+        age = f"{minutes // 60} ч."
+    else:
+        age = f"{minutes // (24 * 60)} дн."
+    return f"\n⚠️ Google не ответил, данные {age} назад"
+
+async def report_sheet_error(context, chat_id, sheet_name, e):
+    logger.error(f"Ошибка скачивания {sheet_name}: {e}")
+    await outbound.call(
+        chat_id,
+        context.bot.send_message,
+        chat_id=chat_id,
+        text=f"❌ Ошибка при скачивании {sheet_name}: {str(e)[:100]}"
+    )
+
+def record_job(chat_id, user_id, sheet, mode, started, snapshot, status):
+    """Запись в журнал выгрузок: без запроса к Google, если снимок взят до начала выгрузки"""
+    job_log.record(
+        chat_id=chat_id,
+        user_id=user_id,
+        spreadsheet_id=sheet.spreadsheet_id,
+        gid=sheet.gid,
+        sheet=sheet.name,
+        mode=mode,
+        bytes=snapshot.size if snapshot is not None else None,
+        latency_ms=(time.monotonic() - started) * 1000,
+        cache_hit=None if snapshot is None else int(snapshot.fetched_at < started),
+        status=status,
+    )
+
+async def send_sheet(context, chat_id, sheet, mode='csv', user_id=None):
+    """Скачивает один лист и сразу отправляет его.
+    
+    Возвращает True при успехе, False при ошибке и None, если лист
+    не менялся с прошлой выгрузки пользователя (режим changed).
+    """
+    started = time.monotonic()
+    snapshot = None
+    try:
+        # Берём CSV из кэша или скачиваем (условным запросом)
+        snapshot = await export_cache.get(sheet.spreadsheet_id, sheet.gid)
+        
+        # sha256 последних отправленных пользователю версий листов
+        last_sent = context.user_data.setdefault('last_sent', {})
+        if mode == 'changed' and last_sent.get(sheet.key) == snapshot.sha256:
+            record_job(chat_id, user_id, sheet, mode, started, snapshot, 'unchanged')
+            return None
+        
+        filename = sheet.filename()
+        caption = f"📊 {sheet.name}{stale_note(snapshot)}"
+        
+        # Отправляем файл, не дожидаясь остальных листов
+        if mode == 'gzip':
+            await send_packed(context.bot, chat_id, 'gzip', [(filename, snapshot)], f"{filename}.gz", caption)
+        elif mode in FORMAT_EXTENSIONS:
+            packed_name = os.path.splitext(filename)[0] + FORMAT_EXTENSIONS[mode]
+            await send_packed(context.bot, chat_id, mode, [(filename, snapshot)], packed_name, caption)
+        else:
+            await send_document_cached(context.bot, chat_id, snapshot, filename, caption)
+        last_sent[sheet.key] = snapshot.sha256
+        
+        logger.info(f"Отправлен файл: {filename}")
+        record_job(chat_id, user_id, sheet, mode, started, snapshot, 'sent')
+        return True
+        
+    except Exception as e:
+        record_job(chat_id, user_id, sheet, mode, started, snapshot, 'error')
+        await report_sheet_error(context, chat_id, sheet.name, e)
+        return False
+
+async def send_zip(context, chat_id, dataset, user_id=None):
+    """Скачивает все листы таблицы параллельно и отправляет их одним zip-архивом"""
+    started = time.monotonic()
+    
+    def record(status):
+        for sheet, snapshot in fetched:
+            record_job(chat_id, user_id, sheet, 'zip', started, snapshot, status if snapshot is not None else 'error')
+    
+    async def fetch(sheet):
+        try:
+            return sheet, await export_cache.get(sheet.spreadsheet_id, sheet.gid)
+        except Exception as e:
+            await report_sheet_error(context, chat_id, sheet.name, e)
+            return sheet, None
+    
+    fetched = await asyncio.gather(*(fetch(sheet) for sheet in dataset.sheets))
+    members = [(sheet.filename(), snapshot) for sheet, snapshot in fetched if snapshot is not None]
+    if not members:
+        record('error')
+        return [False] * len(fetched)
+    
+    try:
+        stale = ''.join(sorted({stale_note(snapshot) for filename, snapshot in members}))
+        await send_packed(context.bot, chat_id, 'zip', members, dataset.archive_name, f"📦 {dataset.title}{stale}")
+    except Exception as e:
+        record('error')
+        await report_sheet_error(context, chat_id, dataset.archive_name, e)
+        return [False] * len(fetched)
+    record('sent')
+    
+    last_sent = context.user_data.setdefault('last_sent', {})
+    for sheet, snapshot in fetched:
+        if snapshot is not None:
+            last_sent[sheet.key] = snapshot.sha256
+    logger.info(f"Отправлен архив: {dataset.archive_name} ({len(members)} файлов)")
+    return [snapshot is not None for sheet, snapshot in fetched]
+
+async def run_download(context, chat_id, user, mode='csv'):
+    """Скачивает и отправляет все листы параллельно"""
+    with DOWNLOAD_SECONDS.time(mode=mode):
+        await _run_download(context, chat_id, user, mode)
+
+async def _run_download(context, chat_id, user, mode):
+    datasets = sheet_registry.datasets_for_chat(chat_id)
+    if not datasets:
+        await outbound.call(chat_id, context.bot.send_message, chat_id=chat_id, text="⛔ Для этого чата не настроено ни одной таблицы")
+        logger.info(f"Чату {chat_id} не доступна ни одна таблица")
+        return
+    
+    if mode == 'zip':
+        per_dataset = await asyncio.gather(*(send_zip(context, chat_id, dataset, user.id) for dataset in datasets))
+        results = [result for dataset_results in per_dataset for result in dataset_results]
+    else:
+        results = await asyncio.gather(*(
+            send_sheet(context, chat_id, sheet, mode, user.id)
+            for dataset in datasets for sheet in dataset.sheets
+        ))
+    files_sent = results.count(True)
+    unchanged = results.count(None)
+    
+    if files_sent > 0:
+        final_msg = f"✅ Отправлено {files_sent} файлов"
+        if mode == 'zip':
+            final_msg += " одним архивом" if len(datasets) == 1 else f" в {len(datasets)} архивах"
+        if unchanged:
+            final_msg += f"\n⏭ Без изменений: {unchanged}"
+    elif unchanged:
+        final_msg = "✅ С прошлой выгрузки ничего не изменилось"
+    else:
+        final_msg = "❌ Не удалось скачать файлы"
+        
+    await outbound.call(chat_id, context.bot.send_message, chat_id=chat_id, text=final_msg)
+    logger.info(f"Завершено для пользователя {user.id}: {final_msg}")
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик нажатия на кнопку"""
     query = update.callback_query
-    await query.answer()
+    mode = query.data.removeprefix('download_')
+    if mode not in DOWNLOAD_MODES or not format_available(mode):
+        await query.answer()
+        return
     
-    if query.data == 'download_csv':
+    # Повторные нажатия, пока выгрузка в этом чате не закончилась, игнорируем
+    chat_id = query.message.chat_id
+    refusal = memory_governor.admit()
+    if refusal:
+        await query.answer(refusal, show_alert=True)
+        return
+    if not outbound.begin_job(chat_id):
+        await query.answer("⏳ Предыдущая выгрузка ещё идёт")
+        return
+    try:
+        await query.answer()
         user = query.from_user
-        logger.info(f"Пользователь {user.id} нажал кнопку скачивания")
-        await query.edit_message_text("⏳ Скачиваю файлы...")
-        
-        files_sent = 0
-        
-        for sheet_name, gid in SHEETS.items():
-            try:
-                # Скачиваем CSV
-                url = f"https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}/export?format=csv&gid={gid}"
-                response = requests.get(url, timeout=30)
-                response.raise_for_status()
-                
-                # Определяем красивое имя файла
-                if sheet_name == "Список_карт_номиналов":
-                    filename = "Список карт номиналов.csv"
-                elif sheet_name == "Список_номеров_СБП":
-                    filename = "Список номеров СБП.csv"
-                else:
-                    filename = f"{sheet_name}.csv"
-                
-                # Отправляем файл
-                await context.bot.send_document(
-                    chat_id=query.message.chat_id,
-                    document=response.content,
-                    filename=filename,
-                    caption=f"📊 {sheet_name}"
-                )
-                
-                files_sent += 1
-                logger.info(f"Отправлен файл: {filename}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка скачивания {sheet_name}: {e}")
-                await context.bot.send_message(
-                    chat_id=query.message.chat_id,
-                    text=f"❌ Ошибка при скачивании {sheet_name}: {str(e)[:100]}"
-                )
+        logger.info(f"Пользователь {user.id} нажал кнопку скачивания ({mode})")
+        await outbound.call(chat_id, query.edit_message_text, "⏳ Скачиваю файлы...")
         
-        if files_sent > 0:
-            final_msg = f"✅ Отправлено {files_sent} файлов"
-        else:
-            final_msg = "❌ Не удалось скачать файлы"
-            
-        await context.bot.send_message(chat_id=query.message.chat_id, text=final_msg)
-        logger.info(f"Завершено для пользователя {user.id}: {final_msg}")
+        await run_download(context, chat_id, user, mode)
+    finally:
+        outbound.end_job(chat_id)
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /help"""
@@ -167,30 +3190,130 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📚 Доступные команды:\n"
         "/start - Начать работу\n"
         "/download - Получить CSV файлы\n"
+        "/download changed - Только изменённые с прошлого раза\n"
+        "/download zip - Все листы одним архивом\n"
+        "/download gzip - Каждый лист в gzip\n"
+        "/download xlsx | parquet | jsonl - Каждый лист в другом формате\n"
+        "/download <лист> since <дата> - Строки листа начиная с даты\n"
+        "/find <колонка>=<значение> - Найти строки\n"
+        "/subscribe [лист] - Присылать листы при изменении\n"
+        "/unsubscribe [лист] - Отменить подписку\n"
         "/status - Проверка состояния\n"
         "/help - Справка"
     )
 
 async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /status - проверка работы бота"""
-    import psutil
-    import os
-    
-    process = psutil.Process(os.getpid())
-    memory_mb = process.memory_info().rss / 1024 / 1024
-    uptime = time.time() - process.create_time()
+    # psutil читает /proc - в отдельном потоке, как и в мониторинге памяти
+    memory_mb = await asyncio.to_thread(read_rss_mb)
+    memory = f"{memory_mb:.1f} MB" if memory_mb is not None else "нет данных"
+    uptime = time.monotonic() - STARTED_AT
     
     hours = int(uptime // 3600)
     minutes = int((uptime % 3600) // 60)
     
+    if memory_governor.draining:
+        state = "🔄 Перезапускается"
+    elif memory_governor.overloaded:
+        state = "⏳ Перегружен, новые выгрузки приостановлены"
+    else:
+        state = "✅ Активен"
+    open_circuits = sum(breaker.is_open for breaker in breakers.values())
+    google_state = f"⚡ не отвечает ({open_circuits} табл.), отдаём прошлые версии" if open_circuits else "✅ доступен"
+    if MAX_UPTIME_HOURS > 0:
+        left = max(0, MAX_UPTIME_HOURS * 60 - int(uptime // 60))
+        restart = f"{left // 60}ч {left % 60}м"
+    else:
+        restart = "только при нехватке памяти"
+    
     await update.message.reply_text(
         f"📊 Статус бота:\n"
         f"• Работает: {hours}ч {minutes}м\n"
-        f"• Память: {memory_mb:.1f} MB\n"
-        f"• Состояние: ✅ Активен\n"
-        f"• Перезапуск через: {48-hours}ч {59-minutes}м"
+        f"• Память: {memory}\n"
+        f"• Кэш: {export_cache.hits} попаданий, {export_cache.misses} промахов, "
+        f"{export_cache.coalesced} объединено, {export_cache.not_modified} без изменений "
+        f"({export_cache.size / 1024 / 1024:.1f} MB в памяти, {export_cache.disk_size / 1024 / 1024:.1f} MB на диске)\n"
+        f"• Выгрузок в работе: {len(outbound.active_jobs)}\n"
+        f"• Google: {google_state}\n"
+        f"• Таблицы: {', '.join(dataset.title for dataset in sheet_registry.datasets_for_chat(update.effective_chat.id)) or 'нет доступа'}\n"
+        f"• Состояние: {state}\n"
+        f"• Перезапуск: {restart}"
     )
 
+def is_admin(user):
+    return user is not None and user.id in ADMIN_IDS
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /profile [секунды] - профиль обработчиков для flame graph (только для админов)"""
+    if not is_admin(update.effective_user):
+        await update.message.reply_text("⛔ Команда доступна только администраторам")
+        return
+    if context.bot_data.get('profiling'):
+        await update.message.reply_text("⏳ Профилирование уже идёт")
+        return
+    
+    try:
+        seconds = min(max(int(context.args[0]), 1), PROFILE_MAX_SECONDS) if context.args else 30
+    except ValueError:
+        await update.message.reply_text("Использование: /profile [секунды]")
+        return
+    
+    context.bot_data['profiling'] = True
+    try:
+        await update.message.reply_text(f"🔬 Профилирую {seconds} с...")
+        profiler = SamplingProfiler(threading.get_ident())
+        await asyncio.to_thread(profiler.run, seconds)
+        
+        filename = f"profile_{datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.folded"
+        await outbound.call(
+            update.effective_chat.id,
+            context.bot.send_document,
+            chat_id=update.effective_chat.id,
+            document=profiler.folded().encode('utf-8'),
+            filename=filename,
+            caption=f"🔬 {sum(profiler.samples.values())} семплов за {seconds} с (flamegraph.pl / speedscope)"
+        )
+        logger.info(f"Профиль отправлен администратору {update.effective_user.id}")
+    finally:
+        context.bot_data['profiling'] = False
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats [дни] - сводка по журналу выгрузок (только для админов)"""
+    if not is_admin(update.effective_user):
+        await update.message.reply_text("⛔ Команда доступна только администраторам")
+        return
+    if not JOB_LOG_DB:
+        await update.message.reply_text("📭 Журнал выгрузок отключен (JOB_LOG_DB)")
+        return
+    try:
+        days = max(int(context.args[0]), 1) if context.args else 7
+    except ValueError:
+        await update.message.reply_text("Использование: /stats [дни]")
+        return
+    
+    await job_log.flush()
+    summary = await asyncio.to_thread(job_log.summary, time.time() - days * 86400)
+    count, chats, total_bytes, hit_rate, avg_latency, max_latency, errors = summary['totals']
+    if not count:
+        await update.message.reply_text(f"📭 За {days} дн. выгрузок не было")
+        return
+    
+    lines = [
+        f"📈 Выгрузки за {days} дн.: {count} (чатов: {chats})",
+        f"💾 {total_bytes / 1024 / 1024:.1f} MB, без запроса к Google: {hit_rate or 0:.0%}, ошибок: {errors}",
+        f"⏱ Задержка: средняя {avg_latency:.0f} мс, max {max_latency:.0f} мс",
+        "",
+        "🕐 Часы пик (UTC):",
+    ]
+    lines += [f"  {hour:02d}:00 - {jobs} выгрузок, {size / 1024 / 1024:.1f} MB" for hour, jobs, size in summary['hours']]
+    lines += ["", "📄 Самые тяжёлые листы:"]
+    lines += [
+        f"  {name}: {jobs} выгрузок, {size / 1024 / 1024:.1f} MB, из кэша {hits or 0:.0%}, {latency:.0f} мс"
+        for name, jobs, size, hits, latency in summary['sheets']
+    ]
+    lines += ["", "📦 Режимы: " + ", ".join(f"{mode} {jobs}" for mode, jobs in summary['modes'])]
+    await update.message.reply_text("\n".join(lines))
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик ошибок"""
     logger.error(f"Ошибка: {context.error}")
@@ -200,25 +3323,36 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text="❌ Произошла ошибка. Попробуйте позже."
         )
 
+def register_handlers(application):
+    """Команды, кнопки и обработчик ошибок"""
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("download", download_command))
+    application.add_handler(CommandHandler("find", find_command))
+    application.add_handler(CommandHandler("subscribe", subscribe_command))
+    application.add_handler(CommandHandler("unsubscribe", unsubscribe_command))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("status", status_command))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_error_handler(error_handler)
+
 # ========== ЗАПУСК БОТА С ЗАЩИТОЙ ==========
 def main():
     """Основная функция с защитой от падений"""
     
-    # Устанавливаем обработчики сигналов
-    def signal_handler(signum, frame):
-        logger.info(f"🚦 Получен сигнал {signum}, завершаем работу...")
-        sys.exit(0)
-    
-    signal.signal(signal.SIGTERM, signal_handler)
-    
     # Логируем старт
     start_time = datetime.now()
     logger.info(f"🚀 Бот запущен: {start_time}")
     print("=" * 60)
     print("🛡️  Защищенный бот запущен")
     print(f"📅 Старт: {start_time}")
-    print("⏰ Автоперезапуск через 48 часов")
-    print("📊 Мониторинг памяти каждые 30 минут")
+    if MAX_UPTIME_HOURS > 0:
+        print(f"⏰ Плановый перезапуск через {MAX_UPTIME_HOURS} часов")
+    print(f"📊 Мониторинг памяти каждые {MEMORY_SAMPLE_INTERVAL} секунд")
+    print(f"🌐 Получение обновлений: {BOT_MODE}")
+    if WORKERS > 1:
+        print(f"👷 Процессов-обработчиков: {WORKERS}, общее состояние: {STATE_DB}")
     print("=" * 60)
     
     # Проверка токена
@@ -227,31 +3361,16 @@ def main():
         print("ОШИБКА: Добавьте TELEGRAM_BOT_TOKEN в Environment Variables на Render!")
         return
     
-    # Запускаем мониторинг ресурсов
-    monitor_thread = threading.Thread(target=resource_monitor, daemon=True)
-    monitor_thread.start()
-    
-    # Запускаем таймер автоперезапуска
-    restart_thread = threading.Thread(target=auto_restart_timer, daemon=True)
-    restart_thread.start()
-    
     try:
-        # Создаем приложение
-        application = Application.builder().token(TOKEN).build()
-        
-        # Регистрируем обработчики
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("download", download_command))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("status", status_command))
-        application.add_handler(CallbackQueryHandler(button_handler))
-        
-        # Обработчик ошибок
-        application.add_error_handler(error_handler)
-        
-        # Запускаем бота
-        logger.info("🤖 Бот запущен и ожидает сообщений...")
-        application.run_polling()
+        if WORKERS > 1:
+            # Несколько процессов: здесь только приём обновлений и надзор
+            signum = asyncio.run(run_workers())
+        else:
+            # Запускаем веб-сервер и бота
+            signum = asyncio.run(run_bot())
+        if signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        sys.exit(0)
         
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}")
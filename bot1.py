@@ -1,5 +1,5 @@
 import os
-import requests
+import httpx
 import logging
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
@@ -53,6 +53,42 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ========== АСИНХРОННЫЙ HTTP КЛИЕНТ ==========
+# Один общий пул соединений на весь процесс: keep-alive к Google между
+# запросами и HTTP/2, если установлен пакет h2
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_http_client = None
+
+def get_http_client():
+    """Возвращает общий httpx.AsyncClient (создаётся при первом вызове)"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=HTTP2_AVAILABLE,
+            timeout=httpx.Timeout(30.0, connect=10.0),
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            follow_redirects=True,  # export отвечает редиректом на googleusercontent
+        )
+    return _http_client
+
+async def close_http_client(application=None):
+    """Закрывает пул соединений при остановке бота"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+async def fetch_export(url):
+    """Скачивает выгрузку листа, не блокируя event loop"""
+    response = await get_http_client().get(url)
+    response.raise_for_status()
+    return response.content
+
 # ========== ФУНКЦИИ БОТА ==========
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
@@ -89,14 +125,13 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 # Скачиваем CSV
                 url = f"https://docs.google.com/spreadsheets/d/{SPREADSHEET_ID}/export?format=csv&gid={gid}"
-                response = requests.get(url, timeout=30)
-                response.raise_for_status()
+                content = await fetch_export(url)
                 
                 # Отправляем файл
                 filename = f"{sheet_name}.csv"
                 await context.bot.send_document(
                     chat_id=query.message.chat_id,
-                    document=response.content,
+                    document=content,
                     filename=filename,
                     caption=f"📊 {sheet_name}"
                 )
@@ -155,7 +190,7 @@ def main():
     
     try:
         # Создаем приложение
-        application = Application.builder().token(TOKEN).build()
+        application = Application.builder().token(TOKEN).post_shutdown(close_http_client).build()
         
         # Регистрируем обработчики
         application.add_handler(CommandHandler("start", start))